@@ -2,18 +2,97 @@ import aiohttp
 import logging
 import json
 import asyncio
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 
 logger = logging.getLogger(__name__)
 
+class StreamScheduler:
+    """按会话公平分配并发流名额。
+
+    名额空出时，在有请求等待的会话中优先选正在进行的流最少的，再按最久未获得
+    名额的顺序轮转，因此每个标签页至少能拿到一个名额；同一标签页的多个候选计入
+    该标签页，只在其他标签页没有等待时才占用额外名额。只在事件循环线程中使用。
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.active = {}  # session -> 进行中的流数
+        self.waiting = {}  # session -> 等待中的 future 列表，先来先到
+        self.served = {}  # session -> 上次获得名额的序号
+        self.turn = 0
+
+    @asynccontextmanager
+    async def slot(self, session):
+        await self.acquire(session)
+        try:
+            yield
+        finally:
+            self.release(session)
+
+    async def acquire(self, session):
+        if self.running < self.limit and not self.waiting:
+            self._grant(session)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(session, []).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已经分配但请求被取消，交给下一个等待者
+                self.release(session)
+            else:
+                self._forget(session, future)
+            raise
+
+    def release(self, session):
+        self.running -= 1
+        self.active[session] -= 1
+        if not self.active[session]:
+            del self.active[session]
+        self._wake()
+
+    def _grant(self, session):
+        self.running += 1
+        self.active[session] = self.active.get(session, 0) + 1
+        self.turn += 1
+        self.served[session] = self.turn
+
+    def _forget(self, session, future):
+        futures = self.waiting.get(session, [])
+        if future in futures:
+            futures.remove(future)
+        if not futures:
+            self.waiting.pop(session, None)
+
+    def _wake(self):
+        while self.running < self.limit and self.waiting:
+            session = min(self.waiting, key=lambda s: (self.active.get(s, 0), self.served.get(s, 0)))
+            future = self.waiting[session][0]
+            self._forget(session, future)
+            self._grant(session)
+            future.set_result(None)
+
 class APIClient:
     def __init__(self, options):
         self.options = options
         self.session = None
+        self.stream_slots = None
+        self.background_slots = None
+        self.preconnected = {}  # origin -> 上次预连接的时间
         logger.info("APIClient initialized")
     
     async def setup(self):
         if self.session is None or self.session.closed:
             self.session = aiohttp.ClientSession()
+        if self.stream_slots is None:
+            # 交互请求共享的并发流上限，按会话轮转分配
+            self.stream_slots = StreamScheduler(self.options.max_concurrent_streams)
+            # 压缩等后台请求使用单独的名额，不占用交互请求的名额
+            self.background_slots = asyncio.Semaphore(self.options.background_streams)
         logger.info("APIClient setup")
     
     async def close(self):
@@ -22,25 +101,50 @@ class APIClient:
             self.session = None
             logger.info("APIClient session closed")
     
-    async def call_api_stream(self, service, endpoint, data, api_key):
+    async def preconnect(self, endpoint, ttl=10):
+        """提前建立到模型所在主机的连接（DNS、TCP、TLS），放回连接池供随后的请求复用。"""
+        parts = urlsplit(endpoint)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        now = time.monotonic()
+        # 连接池的 keep-alive 只有十几秒，ttl 内不重复预连接
+        if now - self.preconnected.get(origin, 0) < ttl:
+            return
+        self.preconnected[origin] = now
+        await self.setup()
+        try:
+            async with self.session.head(origin, proxy=self.options.proxies, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                logger.debug(f"Preconnected to {origin} (status {response.status})")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f"Preconnect to {origin} failed: {str(e)}")
+
+    async def call_api_stream(self, service, endpoint, data, api_key, session=None, background=False):
+        """session 为请求所属的会话（标签页），用于公平分配并发名额；
+        background 为 True 的请求（如压缩）走单独的后台名额。"""
         logger.info(f"Calling API stream for service: {service}")
         await self.setup()  # Ensure session is set up
         
         headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        slot = self.background_slots if background else self.stream_slots.slot(session)
         try:
-            async with self.session.post(endpoint, json=data, headers=headers, proxy=self.options.proxies, timeout=aiohttp.ClientTimeout(total=60)) as response:
+            async with slot, self.session.post(endpoint, json=data, headers=headers, proxy=self.options.proxies, timeout=aiohttp.ClientTimeout(total=60)) as response:
                 if response.status == 200:
                     logger.info("API call successful")
-                    async for line in response.content.iter_any():
-                        if line:
-                            try:
-                                line = line.decode('utf-8').strip()
-                                if line.startswith('data: '):
-                                    line = line[6:]
-                                if line and line != '[DONE]':
-                                    yield line
-                            except UnicodeDecodeError:
-                                logger.warning(f"Failed to decode line: {line}")
+                    try:
+                        async for line in response.content.iter_any():
+                            if line:
+                                try:
+                                    line = line.decode('utf-8').strip()
+                                    if line.startswith('data: '):
+                                        line = line[6:]
+                                    if line and line != '[DONE]':
+                                        yield line
+                                except UnicodeDecodeError:
+                                    logger.warning(f"Failed to decode line: {line}")
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # 立即关闭未读完的响应，停止接收 token 并释放连接
+                        response.close()
+                        logger.info("API stream closed before completion")
+                        raise
                 else:
                     error_text = await response.text()
                     logger.error(f"API call failed with status {response.status}: {error_text}")
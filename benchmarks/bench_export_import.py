@@ -0,0 +1,70 @@
+"""导入导出吞吐量基准：生成合成对话写入临时存储，测量各格式的导出和导入速度。
+
+用法：python benchmarks/bench_export_import.py --messages 200000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_manager import ChatManager
+from conversation_io import pa, zstandard
+from options import Options
+from search_index import SearchIndex
+
+def build_store(path, messages, per_session):
+    index = SearchIndex(path)
+    words = [f"w{i}" for i in range(2000)]
+    rng = random.Random(0)
+    batch = []
+    for i in range(messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = " ".join(rng.choice(words) for _ in range(rng.randint(5, 60)))
+        batch.append((f"s{i // per_session}", i % per_session, role, content))
+        if len(batch) == 10000:
+            index.add_messages(batch)
+            batch = []
+    index.add_messages(batch)
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--per-session", type=int, default=100)
+    args = parser.parse_args()
+
+    formats = ["conversations.jsonl", "conversations.jsonl.gz"]
+    if zstandard is not None:
+        formats.append("conversations.jsonl.zst")
+    if pa is not None:
+        formats.append("conversations.parquet")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        options = Options()
+        source = build_store(os.path.join(tmp, "source.db"), args.messages, args.per_session)
+        exporter = ChatManager(None, options, source)
+        print(f"{'format':<26}{'export msg/s':>14}{'import msg/s':>14}{'size MB':>10}")
+        for name in formats:
+            path = os.path.join(tmp, name)
+            start = time.perf_counter()
+            exported = exporter.export_conversations(path)
+            export_time = time.perf_counter() - start
+
+            target = SearchIndex(os.path.join(tmp, f"{name}.db"))
+            importer = ChatManager(None, options, target)
+            start = time.perf_counter()
+            imported = importer.import_conversations(path)
+            import_time = time.perf_counter() - start
+            target.close()
+            assert imported == exported == args.messages
+
+            size = os.path.getsize(path) / 1024 / 1024
+            print(f"{name:<26}{exported / export_time:>14,.0f}{imported / import_time:>14,.0f}{size:>10.1f}")
+        source.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""对话保留窗口的内存基准：用假的流式接口生成长对话，比较不同 retention_messages 下的 RSS。
+
+用法：python benchmarks/bench_retention_rss.py --turns 2000 --reply-size 4000
+每种配置在单独的子进程中运行，互不影响。
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        # 非 Linux 平台退回峰值 RSS（macOS 单位为字节，Linux 为 KB）
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+class FakeAPIClient:
+    def __init__(self, reply_size):
+        self.reply_size = reply_size
+
+    async def call_api_stream(self, service, endpoint, data, api_key, session=None, background=False):
+        chunk = "x" * 200
+        for _ in range(self.reply_size // len(chunk)):
+            yield json.dumps({"choices": [{"delta": {"content": chunk}}]})
+
+async def run_conversation(chat_manager, turns):
+    model = {"name": "fake", "model": "fake", "url": "", "api_key": "test"}
+    for turn in range(turns):
+        async for _ in chat_manager.send_message_stream(f"question {turn}", model, "bench"):
+            pass
+
+def measure(args):
+    from chat_manager import ChatManager
+    from options import Options
+    from search_index import SearchIndex
+
+    options = Options()
+    options.compaction_enabled = False
+    retention = args.retention[0]
+    options.retention_messages = retention
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SearchIndex(os.path.join(tmp, "history.db"))
+        chat_manager = ChatManager(FakeAPIClient(args.reply_size), options, index)
+        before = current_rss_mb()
+        start = time.perf_counter()
+        asyncio.run(run_conversation(chat_manager, args.turns))
+        elapsed = time.perf_counter() - start
+        in_memory = sum(len(m["content"]) for m in chat_manager.conversations["bench"] if m["content"] is not None)
+        print(f"{retention:>10}{elapsed:>10.1f}{current_rss_mb() - before:>15.1f}{in_memory / 1024 / 1024:>19.1f}")
+        index.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--reply-size", type=int, default=4000)
+    parser.add_argument("--retention", type=int, nargs="+", default=[200, 10 ** 9])
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args)
+        return
+    print(f"{'retention':>10}{'time s':>10}{'RSS growth MB':>15}{'text in memory MB':>19}")
+    for retention in args.retention:
+        subprocess.run([sys.executable, __file__, "--child", "--turns", str(args.turns),
+                        "--reply-size", str(args.reply_size), "--retention", str(retention)], check=True)
+
+if __name__ == "__main__":
+    main()
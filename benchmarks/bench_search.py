@@ -0,0 +1,68 @@
+"""搜索延迟基准：生成含英文单词、带下划线的标识符和中文的合成对话，测量各类查询的延迟。
+
+用法：python benchmarks/bench_search.py --messages 300000
+覆盖三元组路径（长词、长短混合）、整句短语（多个短词）、二元组路径（一两个字符）
+和全表扫描（只有符号）几种情况，每个查询重复多次取中位数。
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import SearchIndex
+
+QUERIES = ["python", "w12 w13", "w1 w2", "12 w13", "w1234 w", "w1", "z", "错误", "_", "__", "max_retries", "重试 w5"]
+
+def build_store(path, messages, per_session):
+    index = SearchIndex(path)
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(2000)]
+    identifiers = ["max_retries", "retry_delay", "__init__", "session_id", "_bigrams"]
+    chinese = ["错误", "重试", "会话", "搜索", "压缩", "候选"]
+    batch = []
+    for i in range(messages):
+        parts = [rng.choice(words) for _ in range(rng.randint(5, 40))]
+        if rng.random() < 0.01:
+            parts.insert(rng.randrange(len(parts)), rng.choice(identifiers))
+        if rng.random() < 0.05:
+            parts.insert(rng.randrange(len(parts)), rng.choice(chinese))
+        if i == messages // 2:
+            parts.append("python tips")
+        batch.append((f"s{i // per_session}", i % per_session, "user" if i % 2 == 0 else "assistant", " ".join(parts)))
+        if len(batch) == 10000:
+            index.add_messages(batch)
+            batch = []
+    index.add_messages(batch)
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--per-session", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--queries", nargs="+", default=QUERIES)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        index = build_store(os.path.join(tmp, "history.db"), args.messages, args.per_session)
+        print(f"indexed {args.messages} messages in {time.perf_counter() - start:.1f}s ({index.tokenizer})")
+        print(f"{'query':<16}{'path':<18}{'hits':>6}{'median ms':>12}{'max ms':>10}")
+        for query in args.queries:
+            match = index._match_expression(query)
+            path = match[0] if match is not None else "scan"
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results = index.search(query, limit=20)
+                timings.append((time.perf_counter() - start) * 1000)
+            print(f"{query!r:<16}{path:<18}{len(results):>6}{statistics.median(timings):>12.1f}{max(timings):>10.1f}")
+        index.close()
+
+if __name__ == "__main__":
+    main()
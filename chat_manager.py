@@ -1,62 +1,151 @@
 import json
 import logging
 import asyncio
+import itertools
+import time
+from compactor import ConversationCompactor
+from exceptions import APIException
+from conversation_io import export_records, import_records, group_sessions
 
 logger = logging.getLogger(__name__)
 
 class ChatManager:
-    def __init__(self, api_client, options):
+    def __init__(self, api_client, options, search_index=None, semantic_cache=None):
         self.api_client = api_client
         self.options = options
+        self.search_index = search_index
+        self.semantic_cache = semantic_cache
         self.conversations = {}
+        self.compactor = ConversationCompactor(self)
         self.paused = False
-        self.current_task = None
+        self.tasks = {}  # session_id -> 正在进行的流所在的 asyncio.Task
+        self.cancel_requested = {}  # session_id -> 请求取消的时间，用于记录取消延迟
+        self.candidates = {}  # session_id -> (用户消息, 候选回复, 模型, 失败的候选下标)
+        self.spilled_upto = {}  # session_id -> 已从内存移出原文的消息数
         self.loop = asyncio.get_event_loop()
         logger.info("ChatManager initialized")
     
-    async def send_message_stream(self, message, model):
+    async def send_message_stream(self, message, model, session_id=None, regenerate=False, use_cache=True):
         logger.info(f"Sending message with model: {model['name']}")
         if self.paused:
             logger.warning("Chat is paused")
             yield "聊天已暂停。请恢复以继续。"
             return
 
-        if model["name"] not in self.conversations:
-            self.conversations[model["name"]] = []
-        
-        conversation = self.conversations[model["name"]]
-        conversation.append({"role": "user", "content": message})
+        # 每个会话（标签页）拥有独立的对话历史，未指定时按模型名区分
+        session_id = session_id or model["name"]
+        conversation = self.get_conversation(session_id)
+        task = asyncio.current_task()
+        self.tasks[session_id] = task
+        try:
+            async for content in self._send_with_retries(message, model, session_id, conversation, regenerate, use_cache):
+                yield content
+        finally:
+            if self.tasks.get(session_id) is task:
+                del self.tasks[session_id]
+                # 任务在取消生效前已经结束时，取消请求不会被消费
+                self.cancel_requested.pop(session_id, None)
+
+    async def _send_with_retries(self, message, model, session_id, conversation, regenerate, use_cache):
+        end = self._last_user_index(conversation) + 1 if regenerate else 0
+        if end > 0:
+            # 重新生成：沿用历史中最后一条用户消息，不再重复追加，也不查缓存。
+            # 新回复先写入 target，完整收到后才替换原回复，失败或中断时原回复保留
+            cache_key = self._cache_key(conversation[:end - 1], message)
+            target = []
+        else:
+            regenerate = False
+            cache_key = self._cache_key(conversation, message)
+            conversation.append({"role": "user", "content": message})
+            self._index_message(session_id, conversation)
+            target = conversation
 
-        # Limit conversation history
-        if len(conversation) > self.options.conversation_history_limit:
-            conversation = conversation[-self.options.conversation_history_limit:]
+        if self.semantic_cache is not None and use_cache and not regenerate:
+            cached_answer = self.semantic_cache.get(cache_key, model["name"])
+            if cached_answer is not None:
+                logger.info("Semantic cache hit, answering from cache")
+                conversation.append({"role": "assistant", "content": cached_answer})
+                self._index_message(session_id, conversation)
+                self._after_reply(session_id, conversation, model)
+                # 以字典产出，界面据此把这条回复标记为来自缓存
+                yield {"cached": cached_answer}
+                return
 
         retries = 0
+        completed = False
         while retries < self.options.max_retries:
             try:
-                async for content in self._send_message_stream(conversation, model):
+                # 重试前的等待也放在 try 内，等待期间被中断同样按取消处理
+                if retries:
+                    await asyncio.sleep(self.options.retry_delay)
+                # 完整历史保留在 conversations 中，发送的是摘要加最近消息
+                context = self.compactor.build_context(session_id, conversation[:end] if regenerate else conversation)
+                async for content in self._send_message_stream(session_id, target, context, model):
                     yield content
+                completed = True
                 break
             except asyncio.CancelledError:
-                logger.info("Message stream cancelled")
+                # HTTP 响应已在 APIClient 中关闭，这里把已收到的部分回复写入历史；
+                # 重新生成被中断时丢弃部分回复，保留原回复
+                if not regenerate and conversation[-1]["role"] == "assistant":
+                    self._index_message(session_id, conversation)
+                requested = self.cancel_requested.pop(session_id, None)
+                if requested is not None:
+                    logger.info(f"Message stream cancelled in {(time.perf_counter() - requested) * 1000:.1f} ms")
+                else:
+                    logger.info("Message stream cancelled")
                 yield "消息流已取消。"
                 break
             except Exception as e:
                 logger.exception(f"Error in send_message_stream: {str(e)}")
+                # 失败尝试的不完整回复从未写入存储，立即丢弃，内存与存储保持一致
+                if target and target[-1]["role"] == "assistant":
+                    target.pop()
                 retries += 1
                 if retries < self.options.max_retries:
                     yield f"错误: {str(e)}. 正在重试... ({retries}/{self.options.max_retries})"
-                    await asyncio.sleep(self.options.retry_delay)
                 else:
                     yield f"错误: {str(e)}. 已达到最大重试次数。"
                     break  # 添加这行以在达到最大重试次数后退出循环
 
-    async def _send_message_stream(self, conversation, model):
+        # 回复已经完整收到，之后的记录工作出错不应触发重新发送
+        if not completed:
+            return
+        if regenerate:
+            if not target:
+                logger.warning("Regenerated reply is empty, keeping the previous one")
+                return
+            del conversation[end:]
+            conversation.append(target[-1])
+            if self.search_index is not None:
+                self.search_index.truncate_session(session_id, end)
+        if conversation[-1]["role"] == "assistant":
+            self._index_message(session_id, conversation)
+            answer = conversation[-1]["content"]
+            if self.semantic_cache is not None and not answer.startswith("错误:"):
+                try:
+                    self.semantic_cache.put(cache_key, model["name"], answer)
+                except Exception as e:
+                    logger.exception(f"Failed to cache answer: {str(e)}")
+        self._after_reply(session_id, conversation, model)
+
+    def _after_reply(self, session_id, conversation, model):
+        try:
+            self.compactor.maybe_compact(session_id, conversation, model)
+        except Exception as e:
+            logger.exception(f"Failed to start compaction: {str(e)}")
+        self._enforce_retention(session_id, conversation)
+
+    async def _send_message_stream(self, session_id, conversation, context, model):
         async for response in self.api_client.call_api_stream("openai", model["url"], {
             "model": model["model"],
-            "messages": conversation,
+            "messages": context,
             "stream": True
-        }, model["api_key"]):
+        }, model["api_key"], session=session_id):
+            # 接口错误（HTTP 错误、超时等）作为失败的尝试处理，不能当作回复内容写入历史
+            error = self.stream_error(response)
+            if error is not None:
+                raise APIException(error)
             content = self.parse_stream_response(response)
             if content:
                 yield content
@@ -64,6 +153,16 @@ class ChatManager:
                     conversation.append({"role": "assistant", "content": ""})
                 conversation[-1]["content"] += content
 
+    def stream_error(self, response):
+        """返回 APIClient 以 {"error": ...} 形式产出的错误信息，不是错误时返回 None。"""
+        try:
+            data = json.loads(response)
+        except json.JSONDecodeError:
+            return None
+        if isinstance(data, dict) and 'error' in data:
+            return str(data['error'])
+        return None
+
     def parse_stream_response(self, response):
         try:
             data = json.loads(response)
@@ -97,35 +196,307 @@ class ChatManager:
             logger.exception(f"Error parsing stream response: {str(e)}")
             return ''
 
+    def parse_stream_choices(self, response):
+        """解析可能包含多个 choice（n > 1）的流式数据，返回 (index, content) 列表。"""
+        choices = []
+        for line in response.strip().split('\n'):
+            line = line.strip()
+            if line.startswith('data: '):
+                line = line[6:]
+            if not line or line == '[DONE]':
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Failed to parse JSON line: {line}")
+                continue
+            if 'error' in data:
+                logger.error(f"Received error: {data['error']}")
+                choices.append((0, f"错误: {data['error']}"))
+            for choice in data.get('choices', []):
+                content = choice.get('delta', {}).get('content', '')
+                if content:
+                    choices.append((choice.get('index', 0), content))
+        return choices
+
+    async def generate_candidates(self, message, model, n, session_id=None):
+        """为同一上下文并发生成 n 个候选回复，边生成边产出 (index, delta)。
+
+        用户消息和候选都不会写入历史，需要调用 commit_candidate 或 select_candidate
+        选定其中一个后一起写入；放弃时调用 discard_candidates。出错的候选记入
+        failed_candidates，不能被选用。
+        """
+        logger.info(f"Generating {n} candidates with model: {model['name']}")
+        session_id = session_id or model["name"]
+        conversation = self.get_conversation(session_id)
+        context = self.compactor.build_context(session_id, conversation + [{"role": "user", "content": message}])
+        candidates = [""] * n
+        failed = set()
+        self.candidates[session_id] = (message, candidates, model, failed)
+
+        task = asyncio.current_task()
+        self.tasks[session_id] = task
+        try:
+            if model.get("supports_n"):
+                stream = self._candidates_single_request(session_id, context, model, n)
+            else:
+                stream = self._candidates_parallel(session_id, context, model, n)
+            async for index, content, error in stream:
+                if 0 <= index < n:
+                    if error:
+                        failed.add(index)
+                    candidates[index] += content
+                    yield index, content
+        except asyncio.CancelledError:
+            # 生成被取消时候选不完整，不再保留
+            self.discard_candidates(session_id)
+            logger.info("Candidate generation cancelled")
+        finally:
+            if self.tasks.get(session_id) is task:
+                del self.tasks[session_id]
+                self.cancel_requested.pop(session_id, None)
+
+    async def _candidates_single_request(self, session_id, context, model, n):
+        # 端点支持 n 参数时，一个请求返回全部候选
+        try:
+            async for response in self.api_client.call_api_stream("openai", model["url"], {
+                "model": model["model"],
+                "messages": context,
+                "n": n,
+                "stream": True
+            }, model["api_key"], session=session_id):
+                # 错误块说明整个请求失败，所有候选都作废
+                error = self.stream_error(response)
+                if error is not None:
+                    raise APIException(error)
+                for index, content in self.parse_stream_choices(response):
+                    yield index, content, False
+        except Exception as e:
+            logger.exception(f"Error generating candidates: {str(e)}")
+            for index in range(n):
+                yield index, f"错误: {str(e)}", True
+
+    async def _candidates_parallel(self, session_id, context, model, n):
+        queue = asyncio.Queue()
+
+        async def run(index):
+            try:
+                async for response in self.api_client.call_api_stream("openai", model["url"], {
+                    "model": model["model"],
+                    "messages": context,
+                    "stream": True
+                }, model["api_key"], session=session_id):
+                    error = self.stream_error(response)
+                    if error is not None:
+                        raise APIException(error)
+                    content = self.parse_stream_response(response)
+                    if content:
+                        await queue.put((index, content, False))
+            except Exception as e:
+                logger.exception(f"Error generating candidate {index}: {str(e)}")
+                await queue.put((index, f"错误: {str(e)}", True))
+            finally:
+                await queue.put((index, None, False))
+
+        tasks = [asyncio.ensure_future(run(i)) for i in range(n)]
+        try:
+            remaining = n
+            while remaining:
+                index, content, error = await queue.get()
+                if content is None:
+                    remaining -= 1
+                else:
+                    yield index, content, error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def commit_candidate(self, session_id, index):
+        """把用户消息和选中的候选作为一轮对话写入历史。出错的候选不会写入，
+        候选保留以便改选其他候选。需要在事件循环中调用，写入后和普通回复一样触发压缩。"""
+        if session_id not in self.candidates:
+            logger.warning(f"No candidates for {session_id}")
+            return None
+        message, candidates, model, failed = self.candidates[session_id]
+        if not 0 <= index < len(candidates) or index in failed:
+            logger.warning(f"Candidate {index} for {session_id} is missing or failed")
+            return None
+        del self.candidates[session_id]
+        conversation = self.get_conversation(session_id)
+        conversation.append({"role": "user", "content": message})
+        self._index_message(session_id, conversation)
+        conversation.append({"role": "assistant", "content": candidates[index]})
+        self._index_message(session_id, conversation)
+        self._after_reply(session_id, conversation, model)
+        return candidates[index]
+
+    async def select_candidate(self, session_id, scorer):
+        """用可插拔的评分函数选择候选：scorer(candidates) 返回选中的下标。
+        评分函数只会看到成功生成的候选。"""
+        if session_id not in self.candidates:
+            return None
+        _, candidates, _, failed = self.candidates[session_id]
+        valid = [i for i in range(len(candidates)) if i not in failed]
+        if not valid:
+            logger.warning(f"All candidates for {session_id} failed")
+            return None
+        return await self.commit_candidate(session_id, valid[scorer([candidates[i] for i in valid])])
+
+    def failed_candidates(self, session_id):
+        return set(self.candidates[session_id][3]) if session_id in self.candidates else set()
+
+    def discard_candidates(self, session_id):
+        self.candidates.pop(session_id, None)
+
+    def get_conversation(self, session_id):
+        """返回会话的内存历史。不在内存中时从本地存储读回，
+        新消息的位置接在已有历史之后，不会覆盖之前写入的消息。"""
+        if session_id not in self.conversations:
+            stored = []
+            if self.search_index is not None:
+                rows = list(self.search_index.iter_messages(session_id))
+                if any(r["position"] != i for i, r in enumerate(rows)):
+                    # 位置不连续时，列表下标与存储位置对不上，之后的写入会覆盖已有消息
+                    logger.warning(f"Renumbering non-contiguous positions of {session_id}")
+                    self.search_index.renumber_session(session_id)
+                stored = [{"role": r["role"], "content": r["content"]} for r in rows]
+                if stored:
+                    logger.info(f"Restored {len(stored)} messages of {session_id} from local store")
+            self.conversations[session_id] = stored
+            self._enforce_retention(session_id, stored)
+        return self.conversations[session_id]
+
+    def _last_user_index(self, conversation):
+        for index in range(len(conversation) - 1, -1, -1):
+            if conversation[index]["role"] == "user":
+                return index
+        return -1
+
+    def _enforce_retention(self, session_id, conversation):
+        """把保留窗口之外的消息原文移出内存，需要时从本地存储读回。
+
+        与是否启用压缩无关：构建上下文和压缩需要较早的原文时都通过 load_messages 读回。
+        """
+        if self.search_index is None:
+            return
+        limit = len(conversation) - self.options.retention_messages
+        start = self.spilled_upto.get(session_id, 0)
+        for position in range(start, limit):
+            conversation[position] = {"role": conversation[position]["role"], "content": None}
+        if limit > start:
+            self.spilled_upto[session_id] = limit
+            logger.debug(f"Spilled messages {start}-{limit} of {session_id} to local store")
+
+    def load_messages(self, session_id, start, end):
+        """返回会话中 [start, end) 位置的消息原文，已移出内存的从本地存储读回。"""
+        contents = [m["content"] for m in self.conversations.get(session_id, [])[start:end]]
+        if None in contents and self.search_index is not None:
+            stored = self.search_index.get_messages(session_id, start, end)
+            contents = [c if c is not None else stored.get(start + i, "") for i, c in enumerate(contents)]
+        return contents
+
+    def _cache_key(self, conversation, message):
+        # 带上上一条用户消息，避免“继续”之类依赖上下文的追问命中无关的缓存
+        previous = next((m['content'] for m in reversed(conversation) if m['role'] == 'user'), '') or ''
+        return f"{previous}\n{message}" if previous else message
+
+    def _index_message(self, session_id, conversation):
+        if self.search_index is None or not conversation:
+            return
+        # 会话在流结束前被清空时，迟到的消息不再写回存储（已关闭的会话仍然写入）
+        if self.conversations.get(session_id, conversation) is not conversation:
+            return
+        message = conversation[-1]
+        try:
+            self.search_index.add_message(session_id, len(conversation) - 1, message["role"], message["content"])
+        except Exception as e:
+            logger.exception(f"Failed to index message: {str(e)}")
+
+    def search(self, query, limit=20, session_id=None):
+        if self.search_index is None:
+            return []
+        return self.search_index.search(query, limit=limit, session=session_id)
+
     def pause(self):
         self.paused = True
-        if self.current_task:
-            self.current_task.cancel()
+        self.interrupt()
         logger.info("Chat paused")
 
     def resume(self):
         self.paused = False
         logger.info("Chat resumed")
 
-    def interrupt(self):
-        if self.current_task:
-            self.current_task.cancel()
-        logger.info("Chat interrupted")
+    def interrupt(self, session_id=None):
+        """取消指定会话（未指定时为全部会话）正在进行的流，可以从任意线程调用。"""
+        session_ids = [session_id] if session_id is not None else list(self.tasks)
+        for sid in session_ids:
+            task = self.tasks.get(sid)
+            if task is None or task.done():
+                continue
+            self.cancel_requested[sid] = time.perf_counter()
+            self.loop.call_soon_threadsafe(task.cancel)
+            logger.info(f"Chat interrupted: {sid}")
 
-    def clear_history(self, model_name):
-        if model_name in self.conversations:
-            self.conversations[model_name] = []
-            logger.info(f"Conversation history cleared for {model_name}")
+    def is_streaming(self, session_id):
+        task = self.tasks.get(session_id)
+        return task is not None and not task.done()
+
+    def clear_history(self, session_id):
+        if session_id in self.conversations:
+            self.conversations[session_id] = []
+            self.compactor.reset(session_id)
+            self.spilled_upto.pop(session_id, None)
+            if self.search_index is not None:
+                self.search_index.delete_session(session_id)
+            logger.info(f"Conversation history cleared for {session_id}")
         else:
-            logger.warning(f"No conversation history found for {model_name}")
+            logger.warning(f"No conversation history found for {session_id}")
+
+    def close_session(self, session_id):
+        # 只释放内存中的对话，已写入搜索索引的历史保留
+        self.conversations.pop(session_id, None)
+        self.compactor.reset(session_id)
+        self.spilled_upto.pop(session_id, None)
+        logger.info(f"Session closed: {session_id}")
 
-    def get_last_user_message(self, model_name):
-        if model_name in self.conversations:
-            for message in reversed(self.conversations[model_name]):
-                if message['role'] == 'user':
+    def get_last_user_message(self, session_id):
+        if session_id in self.conversations:
+            for message in reversed(self.conversations[session_id]):
+                if message['role'] == 'user' and message['content'] is not None:
                     return message['content']
         return None
 
+    def iter_records(self):
+        # 有本地存储时从存储导出全部历史，否则导出内存中的会话
+        if self.search_index is not None:
+            yield from self.search_index.iter_messages()
+            return
+        for session_id, conversation in self.conversations.items():
+            for position, message in enumerate(conversation):
+                yield {"session": session_id, "position": position, "role": message["role"], "content": message["content"]}
+
+    def export_conversations(self, path, compression=None):
+        count = export_records(self.iter_records(), path, compression)
+        logger.info(f"Exported {count} messages to {path}")
+        return count
+
+    def import_conversations(self, path, compression=None, batch_size=1000):
+        records = import_records(path, compression)
+        count = 0
+        if self.search_index is not None:
+            while True:
+                batch = list(itertools.islice(records, batch_size))
+                if not batch:
+                    break
+                self.search_index.add_messages((r["session"], r["position"], r["role"], r["content"]) for r in batch)
+                count += len(batch)
+        else:
+            for session_id, messages in group_sessions(records):
+                self.conversations.setdefault(session_id, []).extend(messages)
+                count += len(messages)
+        logger.info(f"Imported {count} messages from {path}")
+        return count
+
     def close(self):
         # 清理资源
         if self.loop.is_running():
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "请将下面的对话内容压缩成一段简洁的摘要，保留事实、结论、用户的偏好和尚未解决的问题，"
+    "省略寒暄和重复内容。如果提供了之前的摘要，请把新内容合并进去，输出一份完整的新摘要。"
+)
+
+class ConversationCompactor:
+    """在后台把较早的对话轮次压缩成摘要，限制每次请求的上下文长度。"""
+
+    def __init__(self, chat_manager):
+        self.chat_manager = chat_manager
+        self.options = chat_manager.options
+        self.states = {}
+        self.encoding = None
+        logger.info("ConversationCompactor initialized")
+
+    def _state(self, session):
+        if session not in self.states:
+            summary, upto = "", 0
+            # 摘要保存在本地存储中，重启或重新打开会话后从上次压缩的位置继续
+            store = self.chat_manager.search_index
+            if store is not None:
+                saved = store.get_summary(session)
+                if saved is not None:
+                    summary, upto = saved
+            self.states[session] = {"summary": summary, "upto": upto, "task": None}
+        return self.states[session]
+
+    def count_tokens(self, contents):
+        if self.encoding is None:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+        return sum(len(self.encoding.encode(content)) + 4 for content in contents)
+
+    def _contents(self, session, conversation, start, end=None):
+        """返回 conversation[start:end] 的原文。保留窗口较小时部分原文已移出内存，从本地存储读回。"""
+        end = len(conversation) if end is None else end
+        contents = [m["content"] for m in conversation[start:end]]
+        if None in contents:
+            contents = self.chat_manager.load_messages(session, start, end)
+        return contents
+
+    def build_context(self, session, conversation):
+        """返回实际发送给模型的消息：摘要 + 尚未压缩的最近消息。"""
+        state = self._state(session)
+        # 压缩任务落后时的兜底，保证请求大小有上限
+        start = max(state["upto"], len(conversation) - self.options.conversation_history_limit)
+        contents = self._contents(session, conversation, start)
+        context = [{"role": m["role"], "content": content} for m, content in zip(conversation[start:], contents)]
+        if state["summary"]:
+            context.insert(0, {"role": "system", "content": f"以下是之前对话的摘要：\n{state['summary']}"})
+        return context
+
+    def maybe_compact(self, session, conversation, model):
+        """未压缩部分超过阈值时，在后台启动一次增量压缩。"""
+        if not self.options.compaction_enabled:
+            return
+        state = self._state(session)
+        if state["task"] is not None and not state["task"].done():
+            return
+
+        if (len(conversation) - state["upto"] <= self.options.conversation_history_limit
+                and self.count_tokens(self._contents(session, conversation, state["upto"]))
+                <= self.options.compaction_token_threshold):
+            return
+
+        # 每次最多压缩 compaction_max_messages 条，恢复的长会话分多次追上，单次请求大小有上限
+        end = min(len(conversation) - self.options.compaction_keep_recent,
+                  state["upto"] + self.options.compaction_max_messages)
+        if end <= state["upto"]:
+            return
+        state["task"] = asyncio.ensure_future(self._compact(session, conversation, state["upto"], end, model))
+
+    async def _compact(self, session, conversation, start, end, model):
+        state = self._state(session)
+        summary_model = self.options.get_model(self.options.compaction_model or "") or model
+        contents = self._contents(session, conversation, start, end)
+        transcript = "\n".join(f"{m['role']}: {content}" for m, content in zip(conversation[start:end], contents))
+        prompt = f"之前的摘要：\n{state['summary']}\n\n新的对话：\n{transcript}" if state["summary"] else transcript
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+        logger.info(f"Compacting messages {start}-{end} of {session} with {summary_model['name']}")
+
+        summary = ""
+        try:
+            async for response in self.chat_manager.api_client.call_api_stream("openai", summary_model["url"], {
+                "model": summary_model["model"],
+                "messages": messages,
+                "stream": True
+            }, summary_model.get("api_key", self.options.get_api_key()), session=session, background=True):
+                summary += self.chat_manager.parse_stream_response(response)
+        except asyncio.CancelledError:
+            logger.info(f"Compaction of {session} cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Error compacting conversation: {str(e)}")
+            return
+
+        if not summary.strip() or summary.startswith("错误:"):
+            logger.warning(f"Compaction of {session} produced no summary: {summary[:100]}")
+            return
+        # 会话在压缩期间被清空时丢弃结果
+        if self.states.get(session) is not state:
+            return
+        state["summary"] = summary.strip()
+        state["upto"] = end
+        logger.info(f"Compacted {session} up to message {end}")
+        store = self.chat_manager.search_index
+        if store is not None:
+            try:
+                store.save_summary(session, state["summary"], end)
+            except Exception as e:
+                logger.exception(f"Failed to save summary of {session}: {str(e)}")
+        # 还有积压时接着压缩下一段
+        state["task"] = None
+        self.maybe_compact(session, conversation, model)
+
+    def get_summary(self, session):
+        return self._state(session)["summary"]
+
+    def reset(self, session):
+        state = self.states.pop(session, None)
+        if state and state["task"] is not None and not state["task"].done():
+            state["task"].cancel()
@@ -0,0 +1,110 @@
+import gzip
+import io
+import json
+import itertools
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+# 每条记录对应一条消息：{"session", "position", "role", "content"}
+FIELDS = ("session", "position", "role", "content")
+# gzip 默认的 9 级比 6 级慢数倍，压缩率只差百分之几
+GZIP_COMPRESSLEVEL = 6
+
+def detect_compression(path):
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path[:-4] if path.endswith('.zst') else path
+    return 'parquet' if name.endswith('.parquet') else 'jsonl'
+
+def open_text(path, mode, compression=None):
+    """按压缩方式打开文本流，mode 为 'r' 或 'w'。"""
+    if compression == 'gzip':
+        return gzip.open(path, mode + 't', compresslevel=GZIP_COMPRESSLEVEL, encoding='utf-8')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd 压缩需要安装 zstandard")
+        raw = open(path, mode + 'b')
+        if mode == 'w':
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def write_jsonl(records, path, compression=None):
+    count = 0
+    with open_text(path, 'w', compression) as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return count
+
+def read_jsonl(path, compression=None):
+    with open_text(path, 'r', compression) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def write_parquet(records, path, batch_size=10000):
+    if pa is None:
+        raise ImportError("导出 Parquet 需要安装 pyarrow")
+    schema = pa.schema([
+        ("session", pa.string()),
+        ("position", pa.int64()),
+        ("role", pa.string()),
+        ("content", pa.string())
+    ])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            columns = {field: [r[field] for r in batch] for field in FIELDS}
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            count += len(batch)
+    return count
+
+def read_parquet(path, batch_size=10000):
+    if pa is None:
+        raise ImportError("导入 Parquet 需要安装 pyarrow")
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=list(FIELDS)):
+        yield from batch.to_pylist()
+
+def export_records(records, path, compression=None):
+    """把消息记录流式写入文件，格式和压缩方式由扩展名决定，返回写入的条数。"""
+    records = iter(records)
+    if detect_format(path) == 'parquet':
+        return write_parquet(records, path)
+    return write_jsonl(records, path, compression or detect_compression(path))
+
+def import_records(path, compression=None):
+    if detect_format(path) == 'parquet':
+        return read_parquet(path)
+    return read_jsonl(path, compression or detect_compression(path))
+
+def group_sessions(records):
+    """把按会话排序的记录流分组为 (session, messages)，每次只在内存中保留一个会话。"""
+    for session, group in itertools.groupby(records, key=lambda r: r["session"]):
+        yield session, [{"role": r["role"], "content": r["content"]} for r in group]
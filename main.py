@@ -1,13 +1,17 @@
 import sys
 import asyncio
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
-                             QPushButton, QTextBrowser, QLineEdit, QLabel, QComboBox, QMenuBar, QMenu, QDialog, QFormLayout, QScrollBar)
+                             QPushButton, QTextBrowser, QLineEdit, QLabel, QComboBox, QMenuBar, QMenu, QDialog, QFormLayout, QScrollBar,
+                             QTabWidget, QFileDialog, QSpinBox)
 from PyQt6.QtGui import QFont, QColor, QAction, QPalette, QTextCharFormat, QTextCursor, QTextBlockFormat, QClipboard, QDesktopServices
 from PyQt6.QtCore import Qt, QThread, pyqtSignal, QObject, QTimer, QUrl
 from api_client import APIClient
 from chat_manager import ChatManager
 from options import Options
+from search_index import SearchIndex
+from semantic_cache import SemanticCache
 import logging
+import uuid
 import tiktoken
 from markdown import markdown
 import re
@@ -19,24 +23,34 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(leve
 logger = logging.getLogger(__name__)
 
 class WorkerSignals(QObject):
+    finished = pyqtSignal(int, str)
+    progress = pyqtSignal(int, str)
+    cached = pyqtSignal(int)
+
+class TaskSignals(QObject):
     finished = pyqtSignal(str)
-    progress = pyqtSignal(str)
 
-class AsyncWorker(QThread):
-    def __init__(self, coro, loop):
+class CandidateSignals(QObject):
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(list)  # 出错的候选下标
+
+class AsyncLoopThread(QThread):
+    """在后台线程中常驻运行事件循环，所有会话的流共享这一个循环和 API 客户端。"""
+
+    def __init__(self, loop):
         super().__init__()
-        self.coro = coro
         self.loop = loop
-        self.signals = WorkerSignals()
 
     def run(self):
-        try:
-            asyncio.set_event_loop(self.loop)
-            result = self.loop.run_until_complete(self.coro)
-            self.signals.finished.emit(result)
-        except Exception as e:
-            logger.exception(f"Error in AsyncWorker: {str(e)}")
-            self.signals.finished.emit(f"Error: {str(e)}")
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.wait()
 
 class ConfigDialog(QDialog):
     def __init__(self, parent=None, options=None):
@@ -103,202 +117,132 @@ class ConfigDialog(QDialog):
             "model_name": self.model_name_input.text()
         }
 
-class ChatGUI(QMainWindow):
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("AI Chat Client")
-        self.setGeometry(100, 100, 900, 700)
+class CandidatesDialog(QDialog):
+    """并排显示同时生成的多个候选回复，用户选定其中一个写入历史。"""
 
-        self.options = Options()
-        self.api_client = APIClient(self.options)
-        self.chat_manager = ChatManager(self.api_client, self.options)
-        self.loop = asyncio.get_event_loop()
-        asyncio.set_event_loop(self.loop)
-        self.worker = None
-        self.dark_mode = True  # 默认使用深色模式
-        self.current_ai_response = ""  # 存储当前AI响应
-        self.current_ai_cursor = None  # 存储AI光标位置
-        self.user_message_cursor = None  # 存储用户消息的光标位置
-        self.current_model_label = None  # 添加这行
+    def __init__(self, parent, n):
+        super().__init__(parent)
+        self.setWindowTitle("候选回复")
+        self.setMinimumSize(300 * n, 400)
+        self.signals = CandidateSignals()
+        self.signals.progress.connect(self.on_progress)
+        self.signals.finished.connect(self.on_finished)
+        self.texts = [""] * n
+        self.selected = None
+        self.future = None
 
-        self.setup_ui()
-        self.setup_menu()
-        self.apply_style()
+        layout = QHBoxLayout(self)
+        self.displays = []
+        self.choose_buttons = []
+        for i in range(n):
+            column = QVBoxLayout()
+            display = QTextBrowser()
+            column.addWidget(display)
+            choose_button = QPushButton(f"选用候选 {i + 1}")
+            choose_button.setEnabled(False)
+            choose_button.clicked.connect(lambda checked=False, index=i: self.choose(index))
+            column.addWidget(choose_button)
+            layout.addLayout(column)
+            self.displays.append(display)
+            self.choose_buttons.append(choose_button)
 
-        # 使用 QTimer 来异步设置 API 客户端
-        QTimer.singleShot(0, self.async_setup_api_client)
+    def on_progress(self, index, content):
+        self.texts[index] += content
+        self.displays[index].setPlainText(self.texts[index])
 
-    def async_setup_api_client(self):
-        asyncio.run_coroutine_threadsafe(self.setup_api_client(), self.loop)
+    def on_finished(self, failed):
+        # 出错的候选不能选用
+        for index, button in enumerate(self.choose_buttons):
+            button.setEnabled(index not in failed)
 
-    def setup_ui(self):
-        central_widget = QWidget()
-        self.setCentralWidget(central_widget)
-        layout = QVBoxLayout(central_widget)
+    def choose(self, index):
+        self.selected = index
+        self.accept()
+
+    def reject(self):
+        if self.future and not self.future.done():
+            self.future.cancel()
+        super().reject()
+
+class ChatSession(QWidget):
+    """一个标签页：拥有独立的对话、聊天显示区域和渲染状态。"""
+
+    def __init__(self, session_id, chat_manager, options, parent=None):
+        super().__init__(parent)
+        self.session_id = session_id
+        self.chat_manager = chat_manager
+        self.options = options
+        self.signals = WorkerSignals()
+        self.signals.progress.connect(self.on_message_progress)
+        self.signals.finished.connect(self.on_message_finished)
+        self.signals.cached.connect(self.on_message_cached)
+        self.future = None  # 当前流对应的 concurrent.futures.Future
+        self.stream_id = 0  # 用于丢弃已取消的流迟到的信号
+        self.active = False  # 是否为当前显示的标签页
+        self.pending_progress = False
+        self.pending_finished = None
+        self.current_ai_response = ""  # 存储当前AI响应
+        self.response_cached = False  # 当前回复是否来自语义缓存
+        self.regenerating = False  # 当前流是否在重新生成最后一条回复
+        self.current_ai_cursor = None  # 存储AI光标位置
+        self.user_message_cursor = None  # 存储用户消息的光标位置
+        self.rendered_from = 0  # 显示区域中第一条消息在对话中的位置
+        self.rendered_to = None  # 跳转到较早的搜索结果时显示区域的结束位置，None 表示显示到最新消息
+        self.message_offsets = {}  # 消息在对话中的位置 -> 在显示区域中的起始位置
+        self.ai_block_start = None  # 当前 AI 消息块在显示区域中的起始位置
+        self.window = options.transcript_retention  # 当前渲染的消息数上限
+        self.rebuilding = False
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
 
         # 聊天显示区域
         self.chat_display = QTextBrowser()
         self.chat_display.setOpenExternalLinks(False)
         self.chat_display.anchorClicked.connect(self.handle_anchor_clicked)
+        # 只读的显示区域不需要撤销栈，否则每次重绘都会累积一份旧内容
+        self.chat_display.document().setUndoRedoEnabled(False)
+        self.chat_display.verticalScrollBar().valueChanged.connect(self.on_scroll)
         layout.addWidget(self.chat_display)
 
-        # 输入区域
-        input_layout = QHBoxLayout()
-        self.msg_entry = QLineEdit()
-        self.msg_entry.setFixedHeight(50)  # 增加输入框的高度
-        self.msg_entry.setFont(QFont("Arial", 12))  # 增加字体大小
-        self.msg_entry.returnPressed.connect(self.send_message)
-        input_layout.addWidget(self.msg_entry)
-
-        send_button = QPushButton("发送")
-        send_button.setFixedSize(70, 50)  # 调整发送按钮的大小
-        send_button.clicked.connect(self.send_message)
-        input_layout.addWidget(send_button)
-
-        layout.addLayout(input_layout)
-
-        # 功能按钮区域
-        button_layout = QHBoxLayout()
-        
-        retry_button = QPushButton("重试")
-        retry_button.clicked.connect(self.retry_last)
-        button_layout.addWidget(retry_button)
-        
-        interrupt_button = QPushButton("中断")
-        interrupt_button.clicked.connect(self.interrupt)
-        button_layout.addWidget(interrupt_button)
-        
-        clear_button = QPushButton("清空")
-        clear_button.clicked.connect(self.clear_chat)
-        button_layout.addWidget(clear_button)
-        
-        layout.addLayout(button_layout)
-
-        # 在模型选择区域添加当前模型标签
-        model_layout = QHBoxLayout()
-        self.model_combo = QComboBox()
-        self.model_combo.addItems(self.options.get_model_names())
-        self.model_combo.setCurrentText(self.options.current_model['name'])  # 设置默认选中的模型
-        self.model_combo.currentTextChanged.connect(self.on_model_changed)
-        model_layout.addWidget(self.model_combo)
-
-        self.current_model_label = QLabel()
-        self.current_model_label.setStyleSheet("color: #808080; margin-left: 10px;")
-        model_layout.addWidget(self.current_model_label)
-
-        layout.addLayout(model_layout)
-
-        # 初始化当前模型标签
-        self.update_current_model_label()
-
-    def apply_style(self):
-        if self.dark_mode:
-            self.setStyleSheet("""
-                QMainWindow, QTextBrowser, QLineEdit, QPushButton, QComboBox {
-                    background-color: #1E1E1E;
-                    color: #FFFFFF;
-                }
-                QMenuBar {
-                    background-color: #2D2D2D;
-                    color: #FFFFFF;
-                }
-                QMenuBar::item:selected, QMenu::item:selected {
-                    background-color: #3E3E3E;
-                }
-                QMenu {
-                    background-color: #2D2D2D;
-                    color: #FFFFFF;
-                }
-                QPushButton {
-                    background-color: #0078D4;
-                    border: none;
-                    padding: 5px;
-                }
-                QPushButton:hover {
-                    background-color: #1084D9;
-                }
-                QComboBox {
-                    border: 1px solid #3E3E3E;
-                }
-            """)
-        else:
-            self.setStyleSheet("")
-
-    def setup_menu(self):
-        menubar = self.menuBar()
-        
-        # File menu
-        file_menu = menubar.addMenu('File')
-        
-        clear_action = QAction('Clear Chat', self)
-        clear_action.triggered.connect(self.clear_chat)
-        file_menu.addAction(clear_action)
-        
-        exit_action = QAction('Exit', self)
-        exit_action.triggered.connect(self.close)
-        file_menu.addAction(exit_action)
-        
-        # Edit menu
-        edit_menu = menubar.addMenu('Edit')
-        
-        retry_action = QAction('Retry Last', self)
-        retry_action.triggered.connect(self.retry_last)
-        edit_menu.addAction(retry_action)
-        
-        # Settings menu
-        settings_menu = menubar.addMenu('Settings')
-        
-        config_action = QAction('Configure API', self)
-        config_action.triggered.connect(self.configure_api)
-        settings_menu.addAction(config_action)
-
-        # Add dark mode toggle
-        dark_mode_action = QAction('Toggle Dark Mode', self)
-        dark_mode_action.triggered.connect(self.toggle_dark_mode)
-        settings_menu.addAction(dark_mode_action)
-
-    def toggle_dark_mode(self):
-        self.dark_mode = not self.dark_mode
-        self.apply_style()
-
-    async def setup_api_client(self):
-        await self.api_client.setup()
-
-    def send_message(self):
-        user_input = self.msg_entry.text()
-        if not user_input.strip():
-            return
-        self.msg_entry.clear()
-        
-        # 立即显示用户消息
-        self.display_message(user_input, "user")
-        
+    def start_stream(self, user_input, model_name, loop_thread, regenerate=False, use_cache=True):
+        self.cancel_stream()
+        self.stream_id += 1
+        self.pending_progress = False
+        self.pending_finished = None
         self.current_ai_response = ""  # 重置当前AI响应
+        self.response_cached = False
+        self.regenerating = regenerate
         self.current_ai_cursor = None  # 重置AI光标位置
-        model_name = self.model_combo.currentText()
+        self.future = loop_thread.submit(self.run_stream(self.stream_id, user_input, model_name, regenerate, use_cache))
+
+    def cancel_stream(self):
+        if self.future and not self.future.done():
+            self.future.cancel()
+        self.future = None
 
-        # 清理旧的 worker
-        if self.worker:
-            self.worker.quit()
-            self.worker.wait()
-            self.worker.deleteLater()
+    def is_streaming(self):
+        return self.future is not None and not self.future.done()
 
-        self.worker = AsyncWorker(self.process_message(user_input, model_name), self.loop)
-        self.worker.signals.progress.connect(self.on_message_progress)
-        self.worker.signals.finished.connect(self.on_message_finished)
-        self.worker.start()
+    async def run_stream(self, stream_id, user_input, model_name, regenerate=False, use_cache=True):
+        result = await self.process_message(stream_id, user_input, model_name, regenerate, use_cache)
+        self.signals.finished.emit(stream_id, result or "")
 
-    async def process_message(self, user_input, model_name):
+    async def process_message(self, stream_id, user_input, model_name, regenerate=False, use_cache=True):
         model = self.options.get_model(model_name)
         if model:
             try:
                 full_response = ""
-                async for response in self.chat_manager.send_message_stream(user_input, model):
+                async for response in self.chat_manager.send_message_stream(user_input, model, self.session_id,
+                                                                            regenerate, use_cache):
                     if isinstance(response, dict) and 'error' in response:
-                        self.worker.signals.progress.emit(f"错误: {response['error']}")
+                        self.signals.progress.emit(stream_id, f"错误: {response['error']}")
                         return
+                    if isinstance(response, dict) and 'cached' in response:
+                        self.signals.cached.emit(stream_id)
+                        response = response['cached']
                     full_response += response
-                    self.worker.signals.progress.emit(full_response)
+                    self.signals.progress.emit(stream_id, full_response)
                 return full_response
             except Exception as e:
                 logger.exception(f"Error processing message: {str(e)}")
@@ -307,13 +251,23 @@ class ChatGUI(QMainWindow):
             logger.error(f"Invalid model selected: {model_name}")
             return "Error: Invalid model selected"
 
-    def on_message_progress(self, response):
+    def on_message_progress(self, stream_id, response):
+        if stream_id != self.stream_id:
+            return  # 已被取消的旧流
         self.current_ai_response = response
+        # 后台标签页只缓存内容，切换到该标签页时再绘制
+        if not self.active:
+            self.pending_progress = True
+            return
+        self.render_ai_response()
+
+    def render_ai_response(self):
         cursor = self.chat_display.textCursor()
         
         if self.current_ai_cursor is None:
             # 如果 AI 光标位置未初始化，我们需要创建一个新的 AI 消息块
             cursor.movePosition(QTextCursor.MoveOperation.End)
+            self.ai_block_start = cursor.position()
             block_format = QTextBlockFormat()
             block_format.setAlignment(Qt.AlignmentFlag.AlignLeft)
             cursor.insertBlock(block_format)
@@ -330,12 +284,148 @@ class ChatGUI(QMainWindow):
         self.chat_display.ensureCursorVisible()
         QApplication.processEvents()
 
-    def on_message_finished(self, response):
-        self.add_info_bar(response)
+    def on_message_cached(self, stream_id):
+        if stream_id == self.stream_id:
+            self.response_cached = True
+
+    def on_message_finished(self, stream_id, response):
+        if stream_id != self.stream_id:
+            return
+        if not self.active:
+            self.pending_finished = response
+            return
+        self.finish_response(response)
+
+    def finish_response(self, response):
+        if self.regenerating:
+            # 新回复临时绘制在原回复之后；完成后按历史重绘，原回复被替换，复制链接也随之更新
+            self.regenerating = False
+            self.rebuild_transcript(self.rendered_from)
+            position = self.last_assistant_position()
+            content = self.chat_manager.load_messages(self.session_id, position, position + 1)[0] \
+                if position is not None else None
+            if not content or not response.endswith(content):
+                self.show_temporary_message("重新生成未完成，已保留原回复。")
+            return
+        self.add_info_bar(response, self.last_assistant_position(), self.response_cached)
+        self.trim_transcript()
+
+    def set_active(self, active):
+        self.active = active
+        if not active:
+            return
+        if self.pending_progress:
+            self.pending_progress = False
+            self.render_ai_response()
+        if self.pending_finished is not None:
+            response, self.pending_finished = self.pending_finished, None
+            self.finish_response(response)
+
+    def show_ai_response(self, response):
+        self.stream_id += 1
+        self.current_ai_response = response
+        self.current_ai_cursor = None
+        self.render_ai_response()
+        self.add_info_bar(response, self.last_assistant_position())
+        self.trim_transcript()
+
+    def last_assistant_position(self):
+        conversation = self.chat_manager.conversations.get(self.session_id, [])
+        if conversation and conversation[-1]["role"] == "assistant":
+            return len(conversation) - 1
+        return None
+
+    def trim_transcript(self):
+        total = len(self.chat_manager.conversations.get(self.session_id, []))
+        # 超出窗口一半时才重建，摊薄重绘的开销
+        if total - self.rendered_from > self.window + self.options.transcript_retention // 2:
+            self.window = self.options.transcript_retention
+            self.rebuild_transcript(total - self.window)
+
+    def load_earlier(self):
+        if self.rendered_from == 0 or self.chat_manager.is_streaming(self.session_id):
+            return
+        total = len(self.chat_manager.conversations.get(self.session_id, []))
+        start = max(0, self.rendered_from - self.options.transcript_retention)
+        self.window = (self.rendered_to or total) - start
+        self.rebuild_transcript(start, anchor=self.rendered_from, end=self.rendered_to)
+
+    def show_latest(self):
+        """从较早的消息窗口回到最新的消息，发送新消息前调用。"""
+        if self.rendered_to is None:
+            return
+        total = len(self.chat_manager.conversations.get(self.session_id, []))
+        self.window = self.options.transcript_retention
+        self.rebuild_transcript(max(0, total - self.window))
+
+    def show_message(self, position, query=None):
+        """滚动到指定位置的消息；不在显示区域时围绕该消息重建一个窗口。"""
+        if self.scroll_to_message(position, query):
+            return True
+        if self.chat_manager.is_streaming(self.session_id):
+            return False
+        total = len(self.chat_manager.conversations.get(self.session_id, []))
+        half = self.options.transcript_retention // 2
+        start = max(0, position - half)
+        end = min(total, start + self.options.transcript_retention)
+        self.window = end - start
+        self.rebuild_transcript(start, end=end if end < total else None)
+        return self.scroll_to_message(position, query)
+
+    def on_scroll(self, value):
+        if self.rebuilding or not self.active:
+            return
+        if value == self.chat_display.verticalScrollBar().minimum() and self.rendered_from > 0:
+            self.load_earlier()
+
+    def rebuild_transcript(self, start, anchor=None, end=None):
+        """只渲染 [start, end) 的消息（end 为 None 时到最新消息），
+        窗口之外的消息在滚动到顶部或点击链接时从存储读回。"""
+        self.rebuilding = True
+        try:
+            conversation = self.chat_manager.conversations.get(self.session_id, [])
+            contents = self.chat_manager.load_messages(self.session_id, start, end or len(conversation))
+            self.chat_display.clear()
+            self.message_offsets = {}
+            self.rendered_from = start
+            self.rendered_to = end
+            if start > 0:
+                cursor = self.chat_display.textCursor()
+                cursor.insertHtml(f'<a href="rehydrate://earlier" style="color: #0078D4; text-decoration: none;">加载更早的 {start} 条消息</a>')
+
+            anchor_position = None
+            for offset, content in enumerate(contents):
+                position = start + offset
+                if position == anchor:
+                    anchor_position = self.chat_display.textCursor().position()
+                if conversation[position]["role"] == "user":
+                    self.display_message(content, "user", position)
+                elif conversation[position]["role"] == "assistant":
+                    self.current_ai_cursor = None
+                    self.current_ai_response = content
+                    self.render_ai_response()
+                    self.add_info_bar(content, position)
+
+            if end is not None:
+                cursor = self.chat_display.textCursor()
+                cursor.movePosition(QTextCursor.MoveOperation.End)
+                cursor.insertBlock()
+                cursor.insertHtml(f'<a href="rehydrate://latest" style="color: #0078D4; text-decoration: none;">显示之后的 {len(conversation) - end} 条消息</a>')
 
-    def display_message(self, message, tag):
+            # 加载更早的消息后停留在原来的第一条消息处
+            if anchor_position is not None:
+                cursor = self.chat_display.textCursor()
+                cursor.setPosition(anchor_position)
+                self.chat_display.setTextCursor(cursor)
+                self.chat_display.ensureCursorVisible()
+        finally:
+            self.rebuilding = False
+
+    def display_message(self, message, tag, position=None):
         cursor = self.chat_display.textCursor()
         cursor.movePosition(QTextCursor.MoveOperation.End)
+        if position is not None:
+            self.message_offsets[position] = cursor.position()
         
         block_format = QTextBlockFormat()
         block_format.setBottomMargin(20)  # 设置段落底部边距
@@ -402,7 +492,9 @@ class ChatGUI(QMainWindow):
         
         return html
 
-    def add_info_bar(self, message):
+    def add_info_bar(self, message, position=None, cached=False):
+        if position is not None and self.ai_block_start is not None:
+            self.message_offsets[position] = self.ai_block_start
         char_count = len(message.strip())
         token_count = self.count_tokens(message)
         
@@ -411,10 +503,14 @@ class ChatGUI(QMainWindow):
         cursor.insertBlock()
         
         info_text = f"字数: {char_count} | Tokens: {token_count} | "
+        if cached:
+            # 缓存命中的回复不是模型重新生成的，点击“重试”可以绕过缓存
+            info_text = "来自缓存 | " + info_text
         cursor.insertHtml(f'<span style="color: #808080;">{info_text}</span>')
         
-        # 创建一个可点击的"复制"链接
-        cursor.insertHtml(f'<a href="copy://{len(self.current_ai_response)}" style="color: #0078D4; text-decoration: none;">复制</a>')
+        # 创建一个可点击的"复制"链接，带位置的链接复制时从对话历史读取原文
+        href = f"copy://message/{position}" if position is not None else f"copy://{len(self.current_ai_response)}"
+        cursor.insertHtml(f'<a href="{href}" style="color: #0078D4; text-decoration: none;">复制</a>')
         
         self.chat_display.setTextCursor(cursor)
         self.chat_display.ensureCursorVisible()
@@ -423,6 +519,19 @@ class ChatGUI(QMainWindow):
         encoding = tiktoken.get_encoding("cl100k_base")
         return len(encoding.encode(text))
 
+    def scroll_to_message(self, position, query=None):
+        """滚动到对话中指定位置的消息并选中其中的查询文本，消息不在显示区域时返回 False。"""
+        offset = self.message_offsets.get(position)
+        if offset is None:
+            return False
+        cursor = self.chat_display.document().find(query, offset) if query else QTextCursor()
+        if cursor.isNull():
+            cursor = self.chat_display.textCursor()
+            cursor.setPosition(offset)
+        self.chat_display.setTextCursor(cursor)
+        self.chat_display.ensureCursorVisible()
+        return True
+
     def copy_to_clipboard(self, message):
         clipboard = QApplication.clipboard()
         clipboard.setText(message)
@@ -452,11 +561,19 @@ class ChatGUI(QMainWindow):
         self.chat_display.setTextCursor(cursor)
 
     def handle_anchor_clicked(self, url):
-        if url.scheme() == "copy":
+        if url.scheme() == "rehydrate":
+            if url.host() == "latest":
+                self.show_latest()
+            else:
+                self.load_earlier()
+        elif url.scheme() == "copy":
             try:
                 # 从URL中提取消息长度，如果为空则使用整个响应
                 path = url.path()
-                if path and path != '/':
+                if url.host() == "message":
+                    position = int(path[1:])
+                    message_to_copy = self.chat_manager.load_messages(self.session_id, position, position + 1)[0]
+                elif path and path != '/':
                     message_length = int(path[1:])
                     message_to_copy = self.current_ai_response[:message_length]
                 else:
@@ -480,20 +597,429 @@ class ChatGUI(QMainWindow):
             # 对于其他类型的链接，使用默认的系统行为打开
             QDesktopServices.openUrl(url)
 
+class ChatGUI(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("AI Chat Client")
+        self.setGeometry(100, 100, 900, 700)
+
+        self.options = Options()
+        self.api_client = APIClient(self.options)
+        self.search_index = SearchIndex(self.options.search_index_path)
+        self.semantic_cache = None
+        if self.options.semantic_cache_enabled:
+            self.semantic_cache = SemanticCache(
+                capacity=self.options.semantic_cache_capacity,
+                threshold=self.options.semantic_cache_threshold,
+                path=self.options.semantic_cache_path
+            )
+        self.chat_manager = ChatManager(self.api_client, self.options, self.search_index, self.semantic_cache)
+        self.loop = asyncio.get_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop_thread = AsyncLoopThread(self.loop)
+        self.loop_thread.start()
+        self.dark_mode = True  # 默认使用深色模式
+        self.session_counter = 0
+        self.current_model_label = None  # 添加这行
+        # 在事件循环线程执行的后台任务（导入导出）通过信号把结果交回界面线程
+        self.task_signals = TaskSignals()
+        self.task_signals.finished.connect(lambda message: self.current_session().show_temporary_message(message))
+
+        self.setup_ui()
+        self.setup_menu()
+        self.apply_style()
+
+        # 使用 QTimer 来异步设置 API 客户端
+        QTimer.singleShot(0, self.async_setup_api_client)
+
+    def async_setup_api_client(self):
+        asyncio.run_coroutine_threadsafe(self.setup_api_client(), self.loop)
+
+    def setup_ui(self):
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        layout = QVBoxLayout(central_widget)
+
+        # 会话标签页，每个标签页拥有自己的聊天显示区域
+        self.tabs = QTabWidget()
+        self.tabs.setTabsClosable(True)
+        self.tabs.tabCloseRequested.connect(self.close_session)
+        self.tabs.currentChanged.connect(self.on_tab_changed)
+        new_tab_button = QPushButton("+")
+        new_tab_button.setFixedSize(30, 24)
+        new_tab_button.clicked.connect(self.new_session)
+        self.tabs.setCornerWidget(new_tab_button, Qt.Corner.TopRightCorner)
+        layout.addWidget(self.tabs)
+        self.new_session()
+
+        # 输入区域
+        input_layout = QHBoxLayout()
+        self.msg_entry = QLineEdit()
+        self.msg_entry.setFixedHeight(50)  # 增加输入框的高度
+        self.msg_entry.setFont(QFont("Arial", 12))  # 增加字体大小
+        self.msg_entry.returnPressed.connect(self.send_message)
+        self.msg_entry.textEdited.connect(self.on_typing)
+        input_layout.addWidget(self.msg_entry)
+
+        send_button = QPushButton("发送")
+        send_button.setFixedSize(70, 50)  # 调整发送按钮的大小
+        send_button.clicked.connect(self.send_message)
+        input_layout.addWidget(send_button)
+
+        layout.addLayout(input_layout)
+
+        # 功能按钮区域
+        button_layout = QHBoxLayout()
+        
+        retry_button = QPushButton("重试")
+        retry_button.clicked.connect(self.retry_last)
+        button_layout.addWidget(retry_button)
+        
+        self.candidate_spin = QSpinBox()
+        # 不支持 n 参数的端点为每个候选单独发起一个流，超过并发上限的候选只能排队等待
+        self.candidate_spin.setRange(2, max(2, self.options.max_concurrent_streams))
+        self.candidate_spin.setValue(self.options.candidate_count)
+        self.candidate_spin.setPrefix("N = ")
+        button_layout.addWidget(self.candidate_spin)
+
+        candidates_button = QPushButton("生成候选")
+        candidates_button.clicked.connect(self.generate_candidates)
+        button_layout.addWidget(candidates_button)
+        
+        interrupt_button = QPushButton("中断")
+        interrupt_button.clicked.connect(self.interrupt)
+        button_layout.addWidget(interrupt_button)
+        
+        clear_button = QPushButton("清空")
+        clear_button.clicked.connect(self.clear_chat)
+        button_layout.addWidget(clear_button)
+        
+        layout.addLayout(button_layout)
+
+        # 在模型选择区域添加当前模型标签
+        model_layout = QHBoxLayout()
+        self.model_combo = QComboBox()
+        self.model_combo.addItems(self.options.get_model_names())
+        self.model_combo.setCurrentText(self.options.current_model['name'])  # 设置默认选中的模型
+        self.model_combo.currentTextChanged.connect(self.on_model_changed)
+        model_layout.addWidget(self.model_combo)
+
+        self.current_model_label = QLabel()
+        self.current_model_label.setStyleSheet("color: #808080; margin-left: 10px;")
+        model_layout.addWidget(self.current_model_label)
+
+        # 历史搜索框
+        self.search_entry = QLineEdit()
+        self.search_entry.setPlaceholderText("搜索历史消息...")
+        self.search_entry.returnPressed.connect(self.search_history)
+        model_layout.addWidget(self.search_entry)
+
+        layout.addLayout(model_layout)
+
+        # 初始化当前模型标签
+        self.update_current_model_label()
+
+    def apply_style(self):
+        if self.dark_mode:
+            self.setStyleSheet("""
+                QMainWindow, QTextBrowser, QLineEdit, QPushButton, QComboBox {
+                    background-color: #1E1E1E;
+                    color: #FFFFFF;
+                }
+                QMenuBar {
+                    background-color: #2D2D2D;
+                    color: #FFFFFF;
+                }
+                QMenuBar::item:selected, QMenu::item:selected {
+                    background-color: #3E3E3E;
+                }
+                QMenu {
+                    background-color: #2D2D2D;
+                    color: #FFFFFF;
+                }
+                QPushButton {
+                    background-color: #0078D4;
+                    border: none;
+                    padding: 5px;
+                }
+                QPushButton:hover {
+                    background-color: #1084D9;
+                }
+                QComboBox {
+                    border: 1px solid #3E3E3E;
+                }
+            """)
+        else:
+            self.setStyleSheet("")
+
+    def setup_menu(self):
+        menubar = self.menuBar()
+        
+        # File menu
+        file_menu = menubar.addMenu('File')
+        
+        new_tab_action = QAction('New Tab', self)
+        new_tab_action.setShortcut('Ctrl+T')
+        new_tab_action.triggered.connect(self.new_session)
+        file_menu.addAction(new_tab_action)
+        
+        close_tab_action = QAction('Close Tab', self)
+        close_tab_action.setShortcut('Ctrl+W')
+        close_tab_action.triggered.connect(lambda: self.close_session(self.tabs.currentIndex()))
+        file_menu.addAction(close_tab_action)
+        
+        export_action = QAction('Export Conversations...', self)
+        export_action.triggered.connect(self.export_conversations)
+        file_menu.addAction(export_action)
+        
+        import_action = QAction('Import Conversations...', self)
+        import_action.triggered.connect(self.import_conversations)
+        file_menu.addAction(import_action)
+        
+        clear_action = QAction('Clear Chat', self)
+        clear_action.triggered.connect(self.clear_chat)
+        file_menu.addAction(clear_action)
+        
+        exit_action = QAction('Exit', self)
+        exit_action.triggered.connect(self.close)
+        file_menu.addAction(exit_action)
+        
+        # Edit menu
+        edit_menu = menubar.addMenu('Edit')
+        
+        retry_action = QAction('Retry Last', self)
+        retry_action.triggered.connect(self.retry_last)
+        edit_menu.addAction(retry_action)
+        
+        # Settings menu
+        settings_menu = menubar.addMenu('Settings')
+        
+        config_action = QAction('Configure API', self)
+        config_action.triggered.connect(self.configure_api)
+        settings_menu.addAction(config_action)
+
+        # Add dark mode toggle
+        dark_mode_action = QAction('Toggle Dark Mode', self)
+        dark_mode_action.triggered.connect(self.toggle_dark_mode)
+        settings_menu.addAction(dark_mode_action)
+
+    def toggle_dark_mode(self):
+        self.dark_mode = not self.dark_mode
+        self.apply_style()
+
+    async def setup_api_client(self):
+        await self.api_client.setup()
+
+    def new_session(self):
+        self.session_counter += 1
+        session = ChatSession(f"session-{uuid.uuid4().hex}", self.chat_manager, self.options)
+        index = self.tabs.addTab(session, f"会话 {self.session_counter}")
+        self.tabs.setCurrentIndex(index)
+        return session
+
+    def open_session(self, session_id):
+        """在新标签页中打开已关闭或导入的会话，历史从本地存储读回。"""
+        self.session_counter += 1
+        session = ChatSession(session_id, self.chat_manager, self.options)
+        index = self.tabs.addTab(session, f"会话 {self.session_counter}")
+        total = len(self.chat_manager.get_conversation(session_id))
+        session.rebuild_transcript(max(0, total - session.window))
+        self.tabs.setCurrentIndex(index)
+        return index
+
+    def close_session(self, index):
+        session = self.tabs.widget(index)
+        if session is None:
+            return
+        session.cancel_stream()
+        self.chat_manager.close_session(session.session_id)
+        self.tabs.removeTab(index)
+        session.deleteLater()
+        if self.tabs.count() == 0:
+            self.new_session()
+
+    def current_session(self):
+        return self.tabs.currentWidget()
+
+    def find_session(self, session_id):
+        for index in range(self.tabs.count()):
+            if self.tabs.widget(index).session_id == session_id:
+                return index
+        return -1
+
+    def on_tab_changed(self, index):
+        for i in range(self.tabs.count()):
+            self.tabs.widget(i).set_active(i == index)
+
+    def send_message(self):
+        user_input = self.msg_entry.text()
+        if not user_input.strip():
+            return
+        self.msg_entry.clear()
+        session = self.current_session()
+        session.show_latest()
+        
+        # 立即显示用户消息
+        position = len(self.chat_manager.conversations.get(session.session_id, []))
+        session.display_message(user_input, "user", position)
+        
+        model_name = self.model_combo.currentText()
+        session.start_stream(user_input, model_name, self.loop_thread)
+
+    def search_history(self):
+        query = self.search_entry.text().strip()
+        if not query:
+            return
+        results = self.chat_manager.search(query)
+        if not results:
+            self.current_session().show_temporary_message(f"未找到与“{query}”匹配的消息。")
+            return
+
+        menu = QMenu(self)
+        for result in results:
+            role = "You" if result["role"] == "user" else "AI"
+            index = self.find_session(result["session"])
+            title = self.tabs.tabText(index) if index >= 0 else "历史会话"
+            label = f"[{title}] {role}: {result['snippet']}".replace('\n', ' ')
+            action = menu.addAction(label)
+            action.triggered.connect(lambda checked=False, r=result: self.jump_to_result(query, r))
+        menu.exec(self.search_entry.mapToGlobal(self.search_entry.rect().bottomLeft()))
+
+    def jump_to_result(self, query, result):
+        index = self.find_session(result["session"])
+        if index < 0:
+            index = self.open_session(result["session"])
+        self.tabs.setCurrentIndex(index)
+        session = self.current_session()
+        if not session.show_message(result["position"], query):
+            if self.chat_manager.is_streaming(session.session_id):
+                session.show_temporary_message("回复生成期间无法跳转到较早的消息。")
+            else:
+                session.show_temporary_message("该消息已不在对话历史中。")
+
     def clear_chat(self):
-        self.chat_display.clear()
-        self.chat_manager.clear_history(self.model_combo.currentText())
-        self.show_temporary_message("聊天记录已清空。")
+        session = self.current_session()
+        session.cancel_stream()
+        session.rendered_from = 0
+        session.rendered_to = None
+        session.window = self.options.transcript_retention
+        session.chat_display.clear()
+        session.message_offsets = {}
+        self.chat_manager.clear_history(session.session_id)
+        session.show_temporary_message("聊天记录已清空。")
+
+    def generate_candidates(self):
+        user_input = self.msg_entry.text()
+        if not user_input.strip():
+            return
+        model = self.options.get_model(self.model_combo.currentText())
+        if not model:
+            return
+        self.msg_entry.clear()
+        session = self.current_session()
+        session.cancel_stream()
+        session.show_latest()
+        position = len(self.chat_manager.conversations.get(session.session_id, []))
+        session.display_message(user_input, "user", position)
+
+        n = self.candidate_spin.value()
+        dialog = CandidatesDialog(self, n)
+
+        async def run():
+            try:
+                async for index, content in self.chat_manager.generate_candidates(user_input, model, n, session.session_id):
+                    dialog.signals.progress.emit(index, content)
+            finally:
+                dialog.signals.finished.emit(sorted(self.chat_manager.failed_candidates(session.session_id)))
+
+        dialog.future = self.loop_thread.submit(run())
+        if self.options.candidate_scorer is not None:
+            # 配置了评分函数时等生成完成后自动选择
+            dialog.signals.finished.connect(dialog.accept)
+        if not dialog.exec():
+            # 放弃候选：用户消息没有写入历史，从显示区域移除并放回输入框
+            self.chat_manager.discard_candidates(session.session_id)
+            session.rebuild_transcript(session.rendered_from)
+            self.msg_entry.setText(user_input)
+            return
+        # 写入历史和触发压缩都在事件循环线程中进行
+        if dialog.selected is not None:
+            commit = self.chat_manager.commit_candidate(session.session_id, dialog.selected)
+        else:
+            commit = self.chat_manager.select_candidate(session.session_id, self.options.candidate_scorer)
+        response = self.loop_thread.submit(commit).result()
+        if response is not None:
+            session.show_ai_response(response)
+        else:
+            # 没有可用的候选：用户消息没有写入历史，放回输入框
+            self.chat_manager.discard_candidates(session.session_id)
+            session.rebuild_transcript(session.rendered_from)
+            self.msg_entry.setText(user_input)
+
+    def on_typing(self, text):
+        if not self.options.speculative_prefetch or not text:
+            return
+        model = self.options.get_model(self.model_combo.currentText())
+        if model:
+            self.loop_thread.submit(self.api_client.preconnect(model["url"]))
 
     def retry_last(self):
-        last_message = self.chat_manager.get_last_user_message(self.model_combo.currentText())
-        if last_message:
-            self.msg_entry.setText(last_message)
-            self.send_message()
+        session = self.current_session()
+        last_message = self.chat_manager.get_last_user_message(session.session_id)
+        if not last_message:
+            return
+        session.show_latest()
+        if self.options.speculative_prefetch:
+            # 立即重新生成最后一条回复，不重复追加用户消息；原回复在新回复完成前保持可见
+            session.start_stream(last_message, self.model_combo.currentText(), self.loop_thread, regenerate=True)
+            return
+        # 普通重试作为新一轮发送，但不再查语义缓存，否则只会得到同样的缓存回复
+        position = len(self.chat_manager.conversations.get(session.session_id, []))
+        session.display_message(last_message, "user", position)
+        session.start_stream(last_message, self.model_combo.currentText(), self.loop_thread, use_cache=False)
 
     def interrupt(self):
-        self.chat_manager.interrupt()
-        self.show_temporary_message("已中断当前回复。")
+        session = self.current_session()
+        if not self.chat_manager.is_streaming(session.session_id):
+            session.show_temporary_message("当前没有正在进行的回复。")
+            return
+        self.chat_manager.interrupt(session.session_id)
+        session.show_temporary_message("已中断当前回复。")
+
+    def export_conversations(self):
+        path, _ = QFileDialog.getSaveFileName(self, "导出对话", "conversations.jsonl.gz",
+                                              "JSONL (*.jsonl *.jsonl.gz *.jsonl.zst);;Parquet (*.parquet)")
+        if not path:
+            return
+
+        async def run():
+            # 导出是同步的文件和数据库读写，放到线程池里执行，不阻塞界面和事件循环
+            try:
+                count = await self.loop.run_in_executor(None, self.chat_manager.export_conversations, path)
+                self.task_signals.finished.emit(f"已导出 {count} 条消息。")
+            except Exception as e:
+                logger.exception(f"Error exporting conversations: {str(e)}")
+                self.task_signals.finished.emit(f"导出失败：{str(e)}")
+
+        self.loop_thread.submit(run())
+        self.current_session().show_temporary_message("正在导出对话...")
+
+    def import_conversations(self):
+        path, _ = QFileDialog.getOpenFileName(self, "导入对话", "",
+                                              "JSONL (*.jsonl *.jsonl.gz *.jsonl.zst);;Parquet (*.parquet)")
+        if not path:
+            return
+
+        async def run():
+            try:
+                count = await self.loop.run_in_executor(None, self.chat_manager.import_conversations, path)
+                self.task_signals.finished.emit(f"已导入 {count} 条消息，可通过搜索打开。")
+            except Exception as e:
+                logger.exception(f"Error importing conversations: {str(e)}")
+                self.task_signals.finished.emit(f"导入失败：{str(e)}")
+
+        self.loop_thread.submit(run())
+        self.current_session().show_temporary_message("正在导入对话...")
 
     def configure_api(self):
         dialog = ConfigDialog(self, self.options)
@@ -533,11 +1059,17 @@ class ChatGUI(QMainWindow):
             self.current_model_label.setText("")
 
     def closeEvent(self, event):
-        if self.worker:
-            self.worker.quit()
-            self.worker.wait()
-        self.loop.stop()
+        for index in range(self.tabs.count()):
+            self.tabs.widget(index).cancel_stream()
+        try:
+            self.loop_thread.submit(self.api_client.close()).result(timeout=5)
+        except Exception as e:
+            logger.exception(f"Error closing API client: {str(e)}")
+        self.loop_thread.stop()
         self.loop.close()
+        self.search_index.close()
+        if self.semantic_cache:
+            self.semantic_cache.flush()
         super().closeEvent(event)
 
 def run():
@@ -13,6 +13,23 @@ class Options:
         self.max_retries = 3
         self.retry_delay = 1
         self.proxies = None
+        self.max_concurrent_streams = 3  # 交互请求的并发流上限，按标签页轮转分配
+        self.background_streams = 1  # 压缩等后台请求的并发流上限，与交互请求分开
+        self.candidate_count = 3
+        self.candidate_scorer = None  # 可选的 scorer(candidates) -> index，设置后自动选择候选
+        self.speculative_prefetch = False  # 输入时预连接，重试时立即重新生成最后一条回复
+        self.search_index_path = "chat_history.db"
+        self.semantic_cache_enabled = False
+        self.semantic_cache_path = "semantic_cache"
+        self.semantic_cache_capacity = 2000
+        self.semantic_cache_threshold = 0.92
+        self.compaction_enabled = True
+        self.compaction_token_threshold = 3000
+        self.compaction_keep_recent = 4
+        self.compaction_max_messages = 40  # 单次压缩最多处理的消息数
+        self.compaction_model = None  # 为 None 时使用当前对话的模型
+        self.retention_messages = 200  # 内存中保留原文的最近消息数，更早的从本地存储读回，与是否启用压缩无关
+        self.transcript_retention = 50  # 每个标签页渲染的最近消息数
 
     def get_api_key(self):
         return self.api_key
@@ -0,0 +1,327 @@
+import re
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 与 unicode61 分词器一致：只有字母和数字组成词元，下划线和其他符号都是分隔符
+WORD_RUN = re.compile(r'[^\W_]+')
+# 二元组的切分方式变化时递增，打开旧数据库时重建二元组索引
+BIGRAM_VERSION = 1
+
+def _bigrams(text):
+    # 为一两个字符的查询建立二元组索引：每段连续文字的所有二元组加上最后一个字符，
+    # 这样任意单个字符都是某个词元的前缀
+    grams = []
+    for run in WORD_RUN.findall(text.lower()):
+        grams.extend(run[i:i + 2] for i in range(len(run) - 1))
+        grams.append(run[-1])
+    return ' '.join(grams)
+
+def _bigram_phrase(query):
+    """把查询转换成二元组索引上的短语，查询中没有字母或数字时返回 None。
+
+    子串中各段文字的二元组在索引里是连续的；后面跟着分隔符的一段在这里结束，
+    还要带上它的末字符词元；查询末尾的单个字符可能是更长一段的开头，按前缀匹配。
+    """
+    query = query.lower()
+    tokens = []
+    prefix = False
+    for match in WORD_RUN.finditer(query):
+        run = match.group()
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        if match.end() < len(query):
+            tokens.append(run[-1])
+        elif len(run) == 1:
+            tokens.append(run)
+            prefix = True
+    if not tokens:
+        return None
+    return '"' + ' '.join(tokens) + '"' + (' *' if prefix else '')
+
+def _contains(content, needle):
+    return needle in content.casefold()
+
+class SearchIndex:
+    """基于 SQLite FTS5 的对话历史全文索引，消息追加时增量更新。"""
+
+    def __init__(self, db_path='chat_history.db', candidate_limit=1000):
+        self.db_path = db_path
+        self.candidate_limit = candidate_limit
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # INSERT OR REPLACE 删除旧行时也要触发删除触发器，保持全文索引同步
+        self.conn.execute("PRAGMA recursive_triggers=ON")
+        self.conn.create_function("bigrams", 1, _bigrams, deterministic=True)
+        self.conn.create_function("contains", 2, _contains, deterministic=True)
+        self.tokenizer = self._detect_tokenizer()
+        self._create_schema()
+        logger.info(f"SearchIndex initialized at {db_path} (tokenizer: {self.tokenizer})")
+
+    def _detect_tokenizer(self):
+        # trigram 分词器可以匹配中文子串，旧版本 SQLite 不支持时退回 unicode61
+        try:
+            self.conn.execute("CREATE VIRTUAL TABLE temp.tokenizer_probe USING fts5(x, tokenize='trigram')")
+            self.conn.execute("DROP TABLE temp.tokenizer_probe")
+            return 'trigram'
+        except sqlite3.OperationalError:
+            return 'unicode61'
+
+    def _create_schema(self):
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    session TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_session_position ON messages(session, position)")
+            # 压缩摘要与消息存在同一个库里，upto 为摘要覆盖到的消息位置（不含）
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS summaries (
+                    session TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    upto INTEGER NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            self.conn.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    content, content='messages', content_rowid='id', tokenize='{self.tokenizer}'
+                )
+            """)
+            has_bigrams = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_bigram'"
+            ).fetchone() is not None
+            bigram_version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            self.conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_bigram USING fts5(
+                    grams, content='', tokenize='unicode61', prefix='1'
+                )
+            """)
+            self.conn.execute("DROP TRIGGER IF EXISTS messages_ai")
+            self.conn.execute("DROP TRIGGER IF EXISTS messages_ad")
+            self.conn.execute("DROP TRIGGER IF EXISTS messages_au")
+            self.conn.execute("""
+                CREATE TRIGGER messages_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+                    INSERT INTO messages_bigram(rowid, grams) VALUES (new.id, bigrams(new.content));
+                END
+            """)
+            self.conn.execute("""
+                CREATE TRIGGER messages_ad AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                    INSERT INTO messages_bigram(messages_bigram, rowid, grams) VALUES ('delete', old.id, bigrams(old.content));
+                END
+            """)
+            self.conn.execute("""
+                CREATE TRIGGER messages_au AFTER UPDATE OF content ON messages BEGIN
+                    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+                    INSERT INTO messages_bigram(messages_bigram, rowid, grams) VALUES ('delete', old.id, bigrams(old.content));
+                    INSERT INTO messages_bigram(rowid, grams) VALUES (new.id, bigrams(new.content));
+                END
+            """)
+            if not has_bigrams or bigram_version < BIGRAM_VERSION:
+                # 旧版本创建的数据库补建或按新的切分方式重建二元组索引
+                if has_bigrams:
+                    self.conn.execute("INSERT INTO messages_bigram(messages_bigram) VALUES ('delete-all')")
+                self.conn.execute("INSERT INTO messages_bigram(rowid, grams) SELECT id, bigrams(content) FROM messages")
+                self.conn.execute(f"PRAGMA user_version = {BIGRAM_VERSION}")
+
+    def add_message(self, session, position, role, content):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO messages(session, position, role, content, created) VALUES (?, ?, ?, ?, ?)",
+                (session, position, role, content, time.time())
+            )
+
+    def add_messages(self, rows):
+        """批量写入 (session, position, role, content) 元组，用于导入。"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO messages(session, position, role, content, created) VALUES (?, ?, ?, ?, ?)",
+                ((session, position, role, content, now) for session, position, role, content in rows)
+            )
+
+    def get_messages(self, session, start, end):
+        """读取会话中 [start, end) 位置的消息内容，返回 {position: content}。"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT position, content FROM messages WHERE session = ? AND position >= ? AND position < ?",
+                (session, start, end)
+            ).fetchall()
+        return dict(rows)
+
+    def iter_messages(self, session=None, batch_size=1000):
+        """按会话和位置顺序分批读取消息，每批单独加锁，不会长时间阻塞写入。"""
+        last = ('' if session is None else session, -1)
+        while True:
+            if session is not None:
+                sql = "SELECT session, position, role, content FROM messages WHERE session = ? AND position > ?"
+            else:
+                sql = "SELECT session, position, role, content FROM messages WHERE (session, position) > (?, ?)"
+            sql += " ORDER BY session, position LIMIT ?"
+            params = [*last, batch_size]
+            with self.lock:
+                rows = self.conn.execute(sql, params).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield {"session": row[0], "position": row[1], "role": row[2], "content": row[3]}
+            last = (rows[-1][0], rows[-1][1])
+
+    def renumber_session(self, session):
+        """把会话中的消息按原有顺序重新编号为连续的位置 0..n-1。"""
+        with self.lock, self.conn:
+            ids = [row[0] for row in self.conn.execute(
+                "SELECT id FROM messages WHERE session = ? ORDER BY position", (session,)
+            )]
+            # 按位置升序改写，新位置不大于原位置，不会与尚未改写的行冲突
+            self.conn.executemany("UPDATE messages SET position = ? WHERE id = ?", enumerate(ids))
+            # 摘要覆盖的位置已经失效，下次压缩时重新生成
+            self.conn.execute("DELETE FROM summaries WHERE session = ?", (session,))
+
+    def truncate_session(self, session, position):
+        """删除会话中 position 及之后的消息，用于重新生成回复。"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE session = ? AND position >= ?", (session, position))
+            self.conn.execute("DELETE FROM summaries WHERE session = ? AND upto > ?", (session, position))
+
+    def delete_session(self, session):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE session = ?", (session,))
+            self.conn.execute("DELETE FROM summaries WHERE session = ?", (session,))
+        logger.info(f"Search index cleared for {session}")
+
+    def get_summary(self, session):
+        """返回会话保存的 (摘要, upto)，没有时返回 None。"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT summary, upto FROM summaries WHERE session = ?", (session,)
+            ).fetchone()
+
+    def save_summary(self, session, summary, upto):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO summaries(session, summary, upto, updated) VALUES (?, ?, ?, ?)",
+                (session, summary, upto, time.time())
+            )
+
+    def search(self, query, limit=20, session=None):
+        """返回按相关度排序的匹配结果，每项包含会话、位置、角色和高亮片段。
+
+        先取最近 candidate_limit 条确实包含查询文本的消息，再按 BM25 打分排序。
+        对单个短语查询，BM25 的 IDF 对所有候选相同，因此只需词频和文档长度两项。
+        """
+        query = query.strip()
+        if not query:
+            return []
+        candidates = self._candidates(query, session)
+        if not candidates:
+            return []
+
+        needle = query.casefold()
+        avg_length = sum(len(row[4]) for row in candidates) / len(candidates)
+        scored = []
+        for row in candidates:
+            content = row[4]
+            tf = content.casefold().count(needle)
+            score = tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * len(content) / avg_length))
+            scored.append((score, row[0], row))
+        scored.sort(key=lambda item: (-item[0], -item[1]))
+        return [self._row_to_result((row[1], row[2], row[3], self._snippet(row[4], needle)))
+                for _, _, row in scored[:limit]]
+
+    def _candidates(self, query, session):
+        needle = query.casefold()
+        match = self._match_expression(query)
+        # 不含大小写字母的查询（符号、数字、中文）不需要折叠大小写，用内置的 instr 校验，
+        # 比逐行调用 Python 函数快得多，全表扫描时尤其明显
+        verify = "instr({}, ?) > 0" if needle.upper() == needle.lower() else "contains({}, ?)"
+        if session is not None:
+            # 单个会话的消息不多，直接按会话索引扫描，不受全局候选上限影响
+            sql = f"""
+                SELECT id, session, position, role, content FROM messages
+                WHERE session = ? AND {verify.format('content')}
+                ORDER BY position DESC LIMIT ?
+            """
+            params = [session, needle, self.candidate_limit]
+        elif match is not None:
+            table, expression = match
+            sql = f"""
+                SELECT m.id, m.session, m.position, m.role, m.content
+                FROM {table} JOIN messages m ON m.id = {table}.rowid
+                WHERE {table} MATCH ? AND {verify.format('m.content')}
+                ORDER BY {table}.rowid DESC LIMIT ?
+            """
+            params = [expression, needle, self.candidate_limit]
+        else:
+            # 含有标点等无法走索引的短查询，退回全表扫描
+            sql = f"""
+                SELECT id, session, position, role, content FROM messages
+                WHERE {verify.format('content')} ORDER BY id DESC LIMIT ?
+            """
+            params = [needle, self.candidate_limit]
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _match_expression(self, query):
+        """生成用于粗筛的 MATCH 表达式，返回 (表名, 表达式)，无法使用索引时返回 None。
+
+        粗筛结果随后用 contains() 精确校验，所以这里只需要不漏掉匹配。
+        """
+        words = [(m.start(), m.group()) for m in re.finditer(r'\S+', query)]
+        spans = [(start, term) for start, term in words if len(term) >= 3]
+        terms = [term for _, term in spans]
+        if self.tokenizer == 'trigram' and terms:
+            phrases = ['"' + t.replace('"', '""') + '"' for t in terms]
+            # 多个词不直接用整句短语：包含空格的三元组几乎出现在每条消息里，代价很高。
+            # 改用 NEAR，距离取查询中首尾两个词之间的三元组个数
+            if len(phrases) == 1:
+                expression = phrases[0]
+            else:
+                first_start, first = spans[0]
+                distance = spans[-1][0] - (first_start + len(first) - 3) - 1
+                expression = f"NEAR({' '.join(phrases)}, {distance})"
+            # 不足三个字符的词无法单独检索，取它在查询中连同后续字符的三个字符一起过滤，
+            # 否则常见的长词会带来大量需要逐条校验的候选
+            windows = {query[start:start + 3] if start + 3 <= len(query) else query[-3:]
+                       for start, term in words if len(term) < 3}
+            for window in sorted(windows):
+                expression += ' AND "' + window.replace('"', '""') + '"'
+            return 'messages_fts', expression
+        if self.tokenizer == 'trigram' and len(query) >= 3:
+            # 全是短词（如 "w1 w2"）时整句作为三元组短语：跨词的三元组很少见，
+            # 比在二元组索引上对每个常见短词分别求交快得多
+            return 'messages_fts', '"' + query.replace('"', '""') + '"'
+        if self.tokenizer != 'trigram' and terms:
+            return 'messages_fts', ' AND '.join('"' + t.replace('"', '""') + '"' for t in terms)
+        phrase = _bigram_phrase(query)
+        return ('messages_bigram', phrase) if phrase is not None else None
+
+    def _snippet(self, content, needle, width=24):
+        start = max(0, content.casefold().find(needle))
+        end = start + len(needle)
+        left = max(0, start - width)
+        right = end + width
+        return ('…' if left > 0 else '') + content[left:start] + '[' + content[start:end] + ']' \
+            + content[end:right] + ('…' if right < len(content) else '')
+
+    def _row_to_result(self, row):
+        session, position, role, snippet = row
+        return {"session": session, "position": position, "role": role, "snippet": snippet}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        logger.info("SearchIndex closed")
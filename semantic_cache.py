@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import threading
+import zlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class HashingEmbedder:
+    """纯 CPU 的字符 n-gram 哈希嵌入，作为语义缓存的默认嵌入函数。"""
+
+    def __init__(self, dim=512, ngram_range=(2, 4)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def __call__(self, text):
+        text = re.sub(r'\s+', ' ', text.lower()).strip()
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(max(len(text) - n + 1, 1)):
+                # crc32 在不同进程间保持稳定，持久化后的向量仍然可用
+                h = zlib.crc32(text[i:i + n].encode('utf-8'))
+                vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+NUMBER = re.compile(r'\d+(?:[.,]\d+)*')
+
+def _numbers(text):
+    # 字符 n-gram 对只差一位数字的提示几乎给出相同的向量（如 12345 * 678 和 12345 * 679），
+    # 命中还要求其中的数字按顺序完全一致
+    return NUMBER.findall(text)
+
+def _entry_key(model_name, text):
+    # 0 表示空槽位，所以哈希值加一
+    return zlib.crc32(f"{model_name}\n{text}".encode('utf-8')) + 1
+
+class SemanticCache:
+    """按嵌入余弦相似度查找的回答缓存，支持 LRU 淘汰和内存映射持久化。"""
+
+    def __init__(self, embedder=None, capacity=2000, threshold=0.92, path=None):
+        self.embedder = embedder or HashingEmbedder()
+        self.capacity = capacity
+        self.threshold = threshold
+        self.path = path
+        self.lock = threading.Lock()
+        self.clock = 0
+        self.dim = len(self.embedder("probe"))
+        self.entries = [None] * capacity
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.keys = None  # 每个槽位的 (模型, 提示) 哈希，与向量一起写入
+        self.vectors = self._open_vectors()
+        logger.info(f"SemanticCache initialized (capacity: {capacity}, threshold: {threshold})")
+
+    def _open_vectors(self):
+        if self.path is None:
+            self.keys = np.zeros(self.capacity, dtype=np.int64)
+            return np.zeros((self.capacity, self.dim), dtype=np.float32)
+
+        vectors_file = self.path + '.npy'
+        keys_file = self.path + '.keys.npy'
+        meta_file = self.path + '.json'
+        if os.path.exists(vectors_file) and os.path.exists(keys_file) and os.path.exists(meta_file):
+            try:
+                vectors = np.load(vectors_file, mmap_mode='r+')
+                keys = np.load(keys_file, mmap_mode='r+')
+                with open(meta_file, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if (vectors.shape == (self.capacity, self.dim) and keys.shape == (self.capacity,)
+                        and len(meta['entries']) == self.capacity):
+                    self.keys = keys
+                    self.entries = meta['entries']
+                    self.last_used = np.array(meta['last_used'], dtype=np.int64)
+                    # 元数据只在 flush 时写入；上次 flush 之后被改写的槽位哈希对不上，
+                    # 说明向量已不属于记录中的条目（例如进程崩溃），丢弃这些槽位
+                    stale = 0
+                    for slot, entry in enumerate(self.entries):
+                        if entry is not None and keys[slot] != _entry_key(entry['model'], entry['prompt']):
+                            self.entries[slot] = None
+                            stale += 1
+                    if stale:
+                        logger.warning(f"Dropped {stale} cached answers not matching their vectors")
+                    self.valid = np.array([e is not None for e in self.entries], dtype=bool)
+                    self.clock = int(self.last_used.max()) if self.capacity else 0
+                    logger.info(f"Loaded {int(self.valid.sum())} cached answers from {self.path}")
+                    return vectors
+                logger.warning(f"Semantic cache at {self.path} has a different shape, rebuilding")
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Error loading semantic cache {self.path}: {str(e)}. Rebuilding.")
+        self.keys = np.lib.format.open_memmap(keys_file, mode='w+', dtype=np.int64, shape=(self.capacity,))
+        return np.lib.format.open_memmap(vectors_file, mode='w+', dtype=np.float32, shape=(self.capacity, self.dim))
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def lookup(self, text, model_name, top_k=1):
+        """返回相似度不低于阈值、模型和数字都一致的前 top_k 个 (相似度, 条目)，按相似度降序排列。"""
+        query = self.embedder(text)
+        numbers = _numbers(text)
+        with self.lock:
+            candidates = np.flatnonzero(self.valid)
+            if candidates.size == 0:
+                return []
+            scores = self.vectors[candidates] @ query
+            order = np.argsort(-scores)[:top_k]
+            results = []
+            for i in order:
+                slot = candidates[i]
+                entry = self.entries[slot]
+                if scores[i] < self.threshold:
+                    break
+                if entry['model'] != model_name or _numbers(entry['prompt']) != numbers:
+                    continue
+                self.last_used[slot] = self._tick()
+                results.append((float(scores[i]), entry))
+            return results
+
+    def get(self, text, model_name):
+        # 多取几个候选，避免最相似的条目属于其它模型
+        results = self.lookup(text, model_name, top_k=5)
+        return results[0][1]['answer'] if results else None
+
+    def put(self, text, model_name, answer):
+        vector = self.embedder(text)
+        with self.lock:
+            slot = self._find_slot(text, model_name)
+            # 先清掉哈希再写向量，中途崩溃时该槽位在加载时被丢弃，而不是对应到旧的回答
+            self.keys[slot] = 0
+            self.vectors[slot] = vector
+            self.keys[slot] = _entry_key(model_name, text)
+            self.entries[slot] = {"model": model_name, "prompt": text, "answer": answer}
+            self.valid[slot] = True
+            self.last_used[slot] = self._tick()
+
+    def _find_slot(self, text, model_name):
+        for slot in np.flatnonzero(self.valid):
+            entry = self.entries[slot]
+            if entry['prompt'] == text and entry['model'] == model_name:
+                return slot
+        free = np.flatnonzero(~self.valid)
+        if free.size:
+            return free[0]
+        # 缓存已满，淘汰最久未使用的条目
+        slot = int(np.argmin(self.last_used))
+        logger.debug(f"Evicting cached answer for: {self.entries[slot]['prompt'][:50]}")
+        return slot
+
+    def flush(self):
+        if self.path is None:
+            return
+        with self.lock:
+            if isinstance(self.vectors, np.memmap):
+                self.vectors.flush()
+                self.keys.flush()
+            with open(self.path + '.json', 'w', encoding='utf-8') as f:
+                json.dump({"entries": self.entries, "last_used": self.last_used.tolist()}, f, ensure_ascii=False)
+        logger.info(f"Semantic cache flushed to {self.path}")
+
+    def clear(self):
+        with self.lock:
+            self.entries = [None] * self.capacity
+            self.keys[:] = 0
+            self.valid[:] = False
+            self.last_used[:] = 0
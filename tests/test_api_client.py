@@ -0,0 +1,44 @@
+import asyncio
+
+from api_client import StreamScheduler
+
+def test_waiting_tab_gets_next_slot():
+    async def run():
+        scheduler = StreamScheduler(2)
+        order = []
+
+        async def stream(session, name, hold):
+            async with scheduler.slot(session):
+                order.append(name)
+                await hold.wait()
+
+        hold = asyncio.Event()
+        # 标签页 a 的两个候选占满名额，随后 a 的第三个候选和标签页 b 排队
+        tasks = [asyncio.ensure_future(stream("a", f"a{i}", hold)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(stream("b", "b0", hold)))
+        await asyncio.sleep(0)
+        assert order == ["a0", "a1"]
+
+        hold.set()
+        await asyncio.gather(*tasks)
+        assert order == ["a0", "a1", "b0", "a2"]
+        assert scheduler.running == 0 and scheduler.active == {} and scheduler.waiting == {}
+
+    asyncio.run(run())
+
+def test_cancelled_waiter_releases_its_place():
+    async def run():
+        scheduler = StreamScheduler(1)
+        await scheduler.acquire("a")
+        waiter = asyncio.ensure_future(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.waiting == {}
+
+        scheduler.release("a")
+        await asyncio.wait_for(scheduler.acquire("c"), timeout=1)
+        assert scheduler.active == {"c": 1}
+
+    asyncio.run(run())
@@ -0,0 +1,110 @@
+import asyncio
+import json
+
+from chat_manager import ChatManager
+from options import Options
+from search_index import SearchIndex
+
+MODEL = {"name": "fake", "model": "fake", "url": "", "api_key": "test"}
+
+class ScriptedAPIClient:
+    """按顺序返回预设回复的假接口，回复为 dict 时按 APIClient 的格式产出错误。"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+
+    async def call_api_stream(self, service, endpoint, data, api_key, session=None, background=False):
+        reply = self.replies.pop(0)
+        if isinstance(reply, dict):
+            yield json.dumps(reply)
+            return
+        for word in reply.split():
+            yield json.dumps({"choices": [{"delta": {"content": word + " "}}]})
+
+def make_manager(replies):
+    options = Options()
+    options.compaction_enabled = False
+    options.retry_delay = 0
+    return ChatManager(ScriptedAPIClient(replies), options, SearchIndex(':memory:'))
+
+async def send(chat_manager, message, **kwargs):
+    return [content async for content in chat_manager.send_message_stream(message, MODEL, "s", **kwargs)]
+
+def stored(chat_manager):
+    return [(r["position"], r["role"], r["content"]) for r in chat_manager.search_index.iter_messages("s")]
+
+def test_regenerate_replaces_answer():
+    async def run():
+        chat_manager = make_manager(["first answer", "second answer"])
+        await send(chat_manager, "q")
+        await send(chat_manager, "q", regenerate=True)
+        assert chat_manager.conversations["s"] == [
+            {"role": "user", "content": "q"},
+            {"role": "assistant", "content": "second answer "}
+        ]
+        assert stored(chat_manager) == [(0, "user", "q"), (1, "assistant", "second answer ")]
+
+    asyncio.run(run())
+
+def test_regenerate_error_keeps_previous_answer():
+    async def run():
+        error = {"error": "API调用失败，状态码: 500"}
+        chat_manager = make_manager(["good answer", error, error, error])
+        await send(chat_manager, "q")
+        output = await send(chat_manager, "q", regenerate=True)
+        assert output[-1].endswith("已达到最大重试次数。")
+        assert chat_manager.conversations["s"][-1] == {"role": "assistant", "content": "good answer "}
+        assert stored(chat_manager) == [(0, "user", "q"), (1, "assistant", "good answer ")]
+
+    asyncio.run(run())
+
+def test_error_reply_is_retried_not_stored():
+    async def run():
+        chat_manager = make_manager([{"error": "API调用超时"}, "recovered"])
+        output = await send(chat_manager, "q")
+        assert "正在重试" in output[0]
+        assert stored(chat_manager) == [(0, "user", "q"), (1, "assistant", "recovered ")]
+
+    asyncio.run(run())
+
+def test_restore_renumbers_position_gaps():
+    async def run():
+        chat_manager = make_manager(["new answer"])
+        chat_manager.search_index.add_messages([
+            ("s", 0, "user", "q1"), ("s", 2, "user", "q2"), ("s", 3, "assistant", "ok")
+        ])
+        await send(chat_manager, "q3")
+        assert stored(chat_manager) == [
+            (0, "user", "q1"), (1, "user", "q2"), (2, "assistant", "ok"),
+            (3, "user", "q3"), (4, "assistant", "new answer ")
+        ]
+        assert [m["content"] for m in chat_manager.conversations["s"]] == [r[2] for r in stored(chat_manager)]
+
+    asyncio.run(run())
+
+async def candidates(chat_manager, message, n):
+    return [item async for item in chat_manager.generate_candidates(message, MODEL, n, "s")]
+
+def test_failed_candidate_cannot_be_committed():
+    async def run():
+        chat_manager = make_manager(["good one", {"error": "API调用失败，状态码: 500"}])
+        await candidates(chat_manager, "q", 2)
+        assert chat_manager.failed_candidates("s") == {1}
+        assert await chat_manager.commit_candidate("s", 1) is None
+        assert stored(chat_manager) == []
+        assert await chat_manager.select_candidate("s", lambda texts: len(texts) - 1) == "good one "
+        assert stored(chat_manager) == [(0, "user", "q"), (1, "assistant", "good one ")]
+
+    asyncio.run(run())
+
+def test_commit_candidate_triggers_compaction():
+    async def run():
+        chat_manager = make_manager(["a", "b"])
+        chat_manager.options.compaction_enabled = True
+        compacted = []
+        chat_manager.compactor.maybe_compact = lambda session, conversation, model: compacted.append(model)
+        await candidates(chat_manager, "q", 2)
+        await chat_manager.commit_candidate("s", 0)
+        assert compacted == [MODEL]
+
+    asyncio.run(run())
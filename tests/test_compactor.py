@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+from chat_manager import ChatManager
+from compactor import SUMMARY_PROMPT
+from options import Options
+from search_index import SearchIndex
+
+MODEL = {"name": "fake", "model": "fake", "url": "", "api_key": "test"}
+
+class WordEncoding:
+    """按空格切分的假编码，避免测试依赖 tiktoken 下载词表。"""
+
+    def encode(self, text):
+        return text.split()
+
+class SummarizingAPIClient:
+    def __init__(self):
+        self.summary_requests = []
+
+    async def call_api_stream(self, service, endpoint, data, api_key, session=None, background=False):
+        if data["messages"][0]["content"] == SUMMARY_PROMPT:
+            self.summary_requests.append(data["messages"][1]["content"])
+            yield json.dumps({"choices": [{"delta": {"content": f"summary {len(self.summary_requests)}"}}]})
+            return
+        yield json.dumps({"choices": [{"delta": {"content": "answer " * 5}}]})
+
+def make_manager(search_index=None, **overrides):
+    options = Options()
+    options.retry_delay = 0
+    for name, value in overrides.items():
+        setattr(options, name, value)
+    chat_manager = ChatManager(SummarizingAPIClient(), options, search_index or SearchIndex(':memory:'))
+    chat_manager.compactor.encoding = WordEncoding()
+    return chat_manager
+
+async def chat(chat_manager, turns, session="s"):
+    for turn in range(turns):
+        async for _ in chat_manager.send_message_stream(f"question {turn}", MODEL, session):
+            pass
+        await settle(chat_manager, session)
+
+async def settle(chat_manager, session="s"):
+    # 压缩完成后可能接着启动下一段，等到没有任务为止
+    state = chat_manager.compactor.states.get(session)
+    while state and state["task"] is not None and not state["task"].done():
+        await state["task"]
+
+def test_compaction_with_small_retention_window():
+    async def run():
+        chat_manager = make_manager(retention_messages=2, conversation_history_limit=10,
+                                    compaction_token_threshold=30, compaction_keep_recent=2)
+        await chat(chat_manager, 4)
+        conversation = chat_manager.conversations["s"]
+        assert any(m["content"] is None for m in conversation)
+        assert chat_manager.api_client.summary_requests
+        assert chat_manager.compactor.get_summary("s").startswith("summary")
+        # 被移出内存的消息在压缩时从存储读回，提示中不会出现 None
+        assert all("None" not in request for request in chat_manager.api_client.summary_requests)
+
+    asyncio.run(run())
+
+def test_summary_persists_across_restart():
+    async def run():
+        index = SearchIndex(':memory:')
+        chat_manager = make_manager(index, compaction_token_threshold=30, compaction_keep_recent=2)
+        await chat(chat_manager, 4)
+        summary = chat_manager.compactor.get_summary("s")
+        upto = chat_manager.compactor.states["s"]["upto"]
+        assert summary and upto
+        assert index.get_summary("s") == (summary, upto)
+
+        restarted = make_manager(index, compaction_token_threshold=30, compaction_keep_recent=2)
+        context = restarted.compactor.build_context("s", restarted.get_conversation("s"))
+        assert summary in context[0]["content"]
+        assert len(context) == len(restarted.conversations["s"]) - upto + 1
+
+        restarted.clear_history("s")
+        assert index.get_summary("s") is None
+
+    asyncio.run(run())
+
+def test_compaction_pass_is_capped():
+    async def run():
+        index = SearchIndex(':memory:')
+        index.add_messages([("s", i, "user" if i % 2 == 0 else "assistant", f"old {i}") for i in range(100)])
+        chat_manager = make_manager(index, compaction_max_messages=30, compaction_keep_recent=2)
+        chat_manager.get_conversation("s")
+        await chat(chat_manager, 1)
+        await settle(chat_manager)
+        requests = chat_manager.api_client.summary_requests
+        assert len(requests) == 4
+        for request in requests:
+            transcript = request.split("新的对话：\n")[-1]
+            assert len(transcript.splitlines()) <= 30
+        assert chat_manager.compactor.states["s"]["upto"] == 100
+
+    asyncio.run(run())
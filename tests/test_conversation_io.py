@@ -0,0 +1,60 @@
+import asyncio
+import gzip
+
+import pytest
+
+from chat_manager import ChatManager
+from conversation_io import export_records, group_sessions, import_records
+from options import Options
+from search_index import SearchIndex
+
+RECORDS = [
+    {"session": "a", "position": 0, "role": "user", "content": "你好"},
+    {"session": "a", "position": 1, "role": "assistant", "content": "line one\nline two \"quoted\""},
+    {"session": "b", "position": 0, "role": "user", "content": ""},
+    {"session": "b", "position": 1, "role": "assistant", "content": "emoji 🙂"},
+]
+
+def make_manager(search_index=None):
+    # ChatManager 在构造时取当前事件循环
+    async def create():
+        return ChatManager(None, Options(), search_index)
+    return asyncio.run(create())
+
+@pytest.mark.parametrize("name", ["conversations.jsonl", "conversations.jsonl.gz"])
+def test_records_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    assert export_records(RECORDS, path) == len(RECORDS)
+    assert list(import_records(path)) == RECORDS
+
+def test_gzip_export_is_gzip(tmp_path):
+    path = str(tmp_path / "conversations.jsonl.gz")
+    export_records(RECORDS, path)
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        assert len(f.read().splitlines()) == len(RECORDS)
+
+def test_group_sessions():
+    assert list(group_sessions(iter(RECORDS))) == [
+        ("a", [{"role": "user", "content": "你好"}, {"role": "assistant", "content": RECORDS[1]["content"]}]),
+        ("b", [{"role": "user", "content": ""}, {"role": "assistant", "content": "emoji 🙂"}]),
+    ]
+
+@pytest.mark.parametrize("name", ["conversations.jsonl", "conversations.jsonl.gz"])
+def test_in_memory_import_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    export_records(RECORDS, path)
+    # 没有本地存储时按会话分组导入内存
+    chat_manager = make_manager()
+    assert chat_manager.import_conversations(path) == len(RECORDS)
+    assert list(chat_manager.iter_records()) == RECORDS
+
+    exported = str(tmp_path / ("again-" + name))
+    assert chat_manager.export_conversations(exported) == len(RECORDS)
+    assert list(import_records(exported)) == RECORDS
+
+def test_store_import_round_trip(tmp_path):
+    path = str(tmp_path / "conversations.jsonl.gz")
+    export_records(RECORDS, path)
+    chat_manager = make_manager(SearchIndex(':memory:'))
+    assert chat_manager.import_conversations(path, batch_size=3) == len(RECORDS)
+    assert [dict(r) for r in chat_manager.iter_records()] == RECORDS
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+from api_client import APIClient
+from chat_manager import ChatManager
+from options import Options
+
+async def start_fake_server(state):
+    """不停推送 SSE 增量的假模型服务，记录客户端断开的时间。"""
+    async def handler(request):
+        response = web.StreamResponse()
+        response.content_type = 'text/event-stream'
+        await response.prepare(request)
+        try:
+            for i in range(100000):
+                chunk = {"choices": [{"delta": {"content": f"t{i} "}}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                await asyncio.sleep(0.005)
+        except (ConnectionResetError, asyncio.CancelledError):
+            state["disconnected"] = time.perf_counter()
+            raise
+        return response
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}/v1/chat/completions"
+
+def test_interrupt_closes_stream_quickly():
+    async def run():
+        state = {"disconnected": None}
+        runner, url = await start_fake_server(state)
+        options = Options()
+        options.compaction_enabled = False
+        api_client = APIClient(options)
+        chat_manager = ChatManager(api_client, options)
+        model = {"name": "fake", "model": "fake", "url": url, "api_key": "test"}
+        received = []
+
+        async def consume():
+            async for content in chat_manager.send_message_stream("hi", model, "s1"):
+                received.append(content)
+
+        try:
+            task = asyncio.ensure_future(consume())
+            await asyncio.sleep(0.3)
+            assert chat_manager.is_streaming("s1")
+
+            start = time.perf_counter()
+            chat_manager.interrupt("s1")
+            await asyncio.wait_for(task, timeout=1)
+            ended = time.perf_counter() - start
+            for _ in range(50):
+                if state["disconnected"] is not None:
+                    break
+                await asyncio.sleep(0.005)
+
+            assert ended < 0.05
+            assert state["disconnected"] is not None
+            assert state["disconnected"] - start < 0.05
+            assert received[-1] == "消息流已取消。"
+            # 已收到的部分回复保留在历史中，取消请求和任务都已清理
+            assert chat_manager.conversations["s1"][-1]["role"] == "assistant"
+            assert chat_manager.cancel_requested == {}
+            assert chat_manager.tasks == {}
+        finally:
+            await api_client.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+class InstantAPIClient:
+    async def call_api_stream(self, service, endpoint, data, api_key, session=None, background=False):
+        for word in ["hi ", "there"]:
+            yield json.dumps({"choices": [{"delta": {"content": word}}]})
+
+def test_interrupt_after_last_chunk_does_not_leak():
+    async def run():
+        options = Options()
+        options.compaction_enabled = False
+        chat_manager = ChatManager(InstantAPIClient(), options)
+        model = {"name": "fake", "model": "fake", "url": "", "api_key": "test"}
+
+        async def consume():
+            # 流在取消回调执行前就已结束，取消请求不会被消费
+            async for content in chat_manager.send_message_stream("hi", model, "s1"):
+                chat_manager.interrupt("s1")
+
+        await asyncio.ensure_future(consume())
+        assert chat_manager.cancel_requested == {}
+        assert chat_manager.conversations["s1"][-1]["content"] == "hi there"
+
+    asyncio.run(run())
+
+class FailingAPIClient:
+    """先产出一段内容再断开的接口，模拟中途失败的尝试。"""
+
+    async def call_api_stream(self, service, endpoint, data, api_key, session=None, background=False):
+        yield json.dumps({"choices": [{"delta": {"content": "partial"}}]})
+        raise ConnectionResetError("connection lost")
+
+def test_interrupt_during_retry_backoff():
+    async def run():
+        options = Options()
+        options.compaction_enabled = False
+        options.retry_delay = 5
+        chat_manager = ChatManager(FailingAPIClient(), options)
+        model = {"name": "fake", "model": "fake", "url": "", "api_key": "test"}
+        received = []
+
+        async def consume():
+            async for content in chat_manager.send_message_stream("hi", model, "s1"):
+                received.append(content)
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)
+        assert "正在重试" in received[-1]
+        chat_manager.interrupt("s1")
+        await asyncio.wait_for(task, timeout=1)
+
+        assert received[-1] == "消息流已取消。"
+        # 失败尝试的部分回复已丢弃，历史只剩用户消息
+        assert chat_manager.conversations["s1"] == [{"role": "user", "content": "hi"}]
+        assert chat_manager.cancel_requested == {}
+
+    asyncio.run(run())
+
+def test_max_retries_discards_partial_reply():
+    async def run():
+        options = Options()
+        options.compaction_enabled = False
+        options.retry_delay = 0
+        chat_manager = ChatManager(FailingAPIClient(), options)
+        model = {"name": "fake", "model": "fake", "url": "", "api_key": "test"}
+        received = [content async for content in chat_manager.send_message_stream("hi", model, "s1")]
+
+        assert received[-1].endswith("已达到最大重试次数。")
+        assert chat_manager.conversations["s1"] == [{"role": "user", "content": "hi"}]
+
+    asyncio.run(run())
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from search_index import SearchIndex
+
+QUERIES = ["_", "__", "a", "ab", "A b", "w1", "w1 w2", "1 w2", "w12 w13", "x_y", "_b", "b_", "错", "错误", "重试 w1",
+           "max_retries", "retries", "Ab_c", "w", "2", "é", ",", "a, b", "  w2  "]
+
+def build_messages(count=600, seed=0):
+    rng = random.Random(seed)
+    vocabulary = ["w1", "w2", "w12", "w13", "a", "b", "ab", "A", "x_y", "__init__", "_b", "b_", "max_retries",
+                  "错误", "重试", "错", "é", "Ab_c", "a,", "2"]
+    return [(f"s{i % 7}", i // 7, "user" if i % 2 == 0 else "assistant",
+             " ".join(rng.choice(vocabulary) for _ in range(rng.randint(1, 8))))
+            for i in range(count)]
+
+def brute_force(messages, query, session=None):
+    needle = query.strip().casefold()
+    return {(s, p) for s, p, _, content in messages
+            if needle in content.casefold() and session in (None, s)}
+
+@pytest.fixture(scope="module")
+def index():
+    index = SearchIndex(':memory:', candidate_limit=10 ** 6)
+    index.messages = build_messages()
+    index.add_messages(index.messages)
+    yield index
+    index.close()
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_search_matches_substring_brute_force(index, query):
+    hits = {(r["session"], r["position"]) for r in index.search(query, limit=10 ** 6)}
+    assert hits == brute_force(index.messages, query)
+
+@pytest.mark.parametrize("query", ["_", "w1 w2", "错"])
+def test_session_search_matches_brute_force(index, query):
+    hits = {(r["session"], r["position"]) for r in index.search(query, session="s3", limit=10 ** 6)}
+    assert hits == brute_force(index.messages, query, "s3")
+
+def test_old_bigram_index_is_rebuilt(tmp_path):
+    path = str(tmp_path / "history.db")
+    messages = build_messages(100)
+    index = SearchIndex(path)
+    index.add_messages(messages)
+    # 模拟旧版本的数据库：二元组索引为空且没有版本号
+    index.conn.execute("INSERT INTO messages_bigram(messages_bigram) VALUES ('delete-all')")
+    index.conn.execute("PRAGMA user_version = 0")
+    index.conn.commit()
+    index.close()
+
+    index = SearchIndex(path)
+    hits = {(r["session"], r["position"]) for r in index.search("ab", limit=10 ** 6)}
+    assert hits and hits == brute_force(messages, "ab")
+    index.close()
@@ -0,0 +1,57 @@
+import numpy as np
+
+from semantic_cache import SemanticCache
+
+def test_similar_prompt_hits_and_unrelated_misses():
+    cache = SemanticCache(capacity=8)
+    cache.put("how do I reverse a list in python", "m", "use reversed()")
+    assert cache.get("how do I reverse a list in python?", "m") == "use reversed()"
+    assert cache.get("what is the capital of france", "m") is None
+
+def test_numbers_must_match_exactly():
+    cache = SemanticCache(capacity=8, threshold=0.92)
+    cache.put("what is 12345 * 678", "m", "8369910")
+    assert cache.get("what is 12345 * 678", "m") == "8369910"
+    # 只差一位数字时向量相似度超过阈值，但不能命中
+    assert cache.embedder("what is 12345 * 679") @ cache.embedder("what is 12345 * 678") >= cache.threshold
+    assert cache.get("what is 12345 * 679", "m") is None
+    assert cache.get("what is 678 * 12345", "m") is None
+
+def test_models_are_isolated():
+    cache = SemanticCache(capacity=8)
+    cache.put("explain recursion", "a", "answer from a")
+    assert cache.get("explain recursion", "b") is None
+    cache.put("explain recursion", "b", "answer from b")
+    assert cache.get("explain recursion", "a") == "answer from a"
+    assert cache.get("explain recursion", "b") == "answer from b"
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(capacity=2)
+    cache.put("first question about sorting", "m", "1")
+    cache.put("second question about hashing", "m", "2")
+    assert cache.get("first question about sorting", "m") == "1"
+    cache.put("third question about graphs", "m", "3")
+    assert cache.get("second question about hashing", "m") is None
+    assert cache.get("first question about sorting", "m") == "1"
+    assert cache.get("third question about graphs", "m") == "3"
+
+def test_reload_drops_slots_written_after_flush(tmp_path):
+    path = str(tmp_path / "cache")
+    cache = SemanticCache(capacity=4, path=path)
+    cache.put("explain recursion", "m", "old")
+    cache.put("explain iteration", "m", "kept")
+    cache.flush()
+    # flush 之后改写了槽位但没有再次 flush，元数据仍指向旧条目
+    slot = next(i for i, e in enumerate(cache.entries) if e and e["prompt"] == "explain recursion")
+    cache.vectors[slot] = cache.embedder("something else entirely")
+    cache.keys[slot] = 12345
+    cache.vectors.flush()
+    cache.keys.flush()
+    del cache
+
+    reloaded = SemanticCache(capacity=4, path=path)
+    assert reloaded.entries[slot] is None
+    assert not reloaded.valid[slot]
+    assert reloaded.get("explain recursion", "m") is None
+    assert reloaded.get("explain iteration", "m") == "kept"
+    assert int(np.count_nonzero(reloaded.valid)) == 1